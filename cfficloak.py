@@ -20,28 +20,81 @@
 
 __version__ = '0.4'
 
+import array
 import collections
-import six
+import gc
+import itertools
+import mmap
+import os
+import pickle
+import re
+import sys
+import threading
 import types
+import weakref
 from functools import wraps
+from random import random as _random
+from time import time as _time
+from timeit import default_timer as _clock
 from collections import namedtuple
 
 try:
-    import cffi
+    import collections.abc as collections_abc
 except ImportError:
-    cffi = None
+    collections_abc = collections
 
 try:
-    try:
-        import numpypy
-    except ImportError:
-        pass
-    import numpy
+    import cffi
 except ImportError:
-    numpy = None
+    cffi = None
 
-if six.PY3:
+# Python 2/3 compatibility, in place of six
+if sys.version_info[0] == 2:
+    _PY2 = True
+    _integer_types = (int, long)
+    _string_types = (basestring,)
+    _text_type = unicode
+else:
     long = int
+    _PY2 = False
+    _integer_types = (int,)
+    _string_types = (str,)
+    _text_type = str
+_binary_type = bytes
+
+# numpy takes longer to import than everything else here put together, so
+# it's only imported the first time it's needed, see _numpy().
+_numpy_module = False
+
+
+def _numpy():
+    ''' The numpy module, imported on first use, or None if it's missing. '''
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            try:
+                import numpypy
+            except ImportError:
+                pass
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_module = numpy
+    return _numpy_module
+
+
+def _isndarray(obj):
+    # Nothing can be an ndarray unless something else has imported numpy
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(obj, numpy.ndarray)
+
+
+def __getattr__(name):
+    # cfficloak.numpy used to be imported eagerly
+    if name == 'numpy':
+        return _numpy()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
 
 __all__ = [
     'CFunction',
@@ -49,23 +102,62 @@ __all__ = [
     'CUnion',
     'CStructType',
     'CUnionType',
+    'CStructArray',
+    'StructWriter',
+    'SharedArray',
+    'StructRing',
     'CObject',
+    'CObjectType',
     'NullError',
+    'ErrnoError',
+    'errnocheck',
     'cmethod',
     'cstaticmethod',
     'cproperty',
+    'cinvalidate',
     'wrap',
     'wrapall',
     'wrapenum',
+    'wrapenum_array',
     'carray',
+    'pool_stats',
+    'AllocSite',
+    'track_allocations',
+    'allocation_stats',
+    'track_objects',
+    'live_objects',
+    'report_leaks',
+    'CallStats',
+    'enable_stats',
+    'disable_stats',
+    'stats',
+    'Hook',
+    'HookedCall',
+    'add_hook',
+    'CallHistory',
+    'record_calls',
+    'replay',
+    'arena',
+    'allocator',
+    'set_allocator',
+    'MmapAllocator',
     'nparrayptr',
+    'register_ffi',
 ]
 
 
-if cffi:
-    _global_ffi = cffi.FFI()
-else:
-    _global_ffi = None
+# The module's own FFI, for arrays of standard C types etc. Creating an FFI
+# imports cffi's C parser, so it's only done on first use by _globalffi().
+_global_ffi = None
+
+
+def _globalffi():
+    global _global_ffi
+    if _global_ffi is None:
+        if not cffi:
+            raise NotImplementedError("cffi module required")
+        _global_ffi = cffi.FFI()
+    return _global_ffi
 
 
 _endian = None
@@ -75,7 +167,8 @@ def load_endian_translate():
     if not cffi:
         raise NotImplementedError("cffi module required")
     import platform
-    _global_ffi.cdef("""
+    ffi = _globalffi()
+    ffi.cdef("""
     uint32_t htonl(uint32_t hostlong);
     uint16_t htons(uint16_t hostshort);
     uint32_t ntohl(uint32_t netlong);
@@ -83,7 +176,7 @@ def load_endian_translate():
     """)
 
     if platform.system() == 'Windows':
-        _global_ffi.cdef("""
+        ffi.cdef("""
         uint64_t htonll(uint64_t hostlong);
         uint64_t ntohll(uint64_t netlong);
         uint32_t htonf(float hostfloat);
@@ -92,7 +185,7 @@ def load_endian_translate():
         double ntohd(uint64_t netdouble);
         """)
         global _endian
-        _endian = _global_ffi.dlopen("Ws2_32")
+        _endian = ffi.dlopen("Ws2_32")
 
     else:
         raise NotImplementedError()
@@ -122,7 +215,41 @@ def load_endian_translate():
 
 
 class NullError(Exception):
-    pass
+    ''' Raised by the default error checker when a C function returning a
+    pointer returns NULL.
+
+    Can be raised with a plain message, or with the failing ``CFunction`` and
+    its arguments, in which case the message is only formatted when the
+    exception is actually displayed.
+
+    '''
+
+    def __init__(self, msg=None, args=None):
+        super(NullError, self).__init__(msg, args)
+
+    def __str__(self):
+        msg, args = self.args
+        if isinstance(msg, CFunction):
+            return 'NULL returned by {0} with args {1}. '.format(msg.cname, args)
+        return str(msg)
+
+
+class ErrnoError(OSError):
+    ''' Raised by ``errnocheck`` checkers when a C function signals failure.
+
+    ``errno`` is captured from ``ffi.errno`` straight after the call, the
+    message is only formatted when the exception is displayed.
+
+    '''
+
+    def __init__(self, errno, cfunc, args):
+        super(ErrnoError, self).__init__(errno, None)
+        self.cfunc = cfunc
+        self.cargs = args
+
+    def __str__(self):
+        return '[Errno {0}] {1}: returned by {2} with args {3}'.format(
+            self.errno, os.strerror(self.errno), self.cfunc.cname, self.cargs)
 
 
 class dotdict(dict):
@@ -133,6 +260,498 @@ class dotdict(dict):
     __delattr__ = dict.__delitem__
 
 
+# All free lists by name, for pool_stats()
+_pools = {}
+_struct_pool_ids = itertools.count(1)
+
+
+class FreeList(object):
+    ''' A bounded free list of native allocations, used for the opt-in
+    pooling of ``CStructType`` and ``CObject`` allocations.
+
+    * ``size``: The most items kept for reuse.
+    * ``release``: Called with any item which doesn't fit in the list, or
+      None to just drop it.
+
+    ``hits`` and ``misses`` count ``get()`` calls which did and didn't find a
+    free item.
+
+    '''
+
+    def __init__(self, size, release=None):
+        self.size = size
+        self.release = release
+        self.items = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        ''' Returns a free item, or None if the list is empty. '''
+        try:
+            item = self.items.pop()
+        except IndexError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item
+
+    def put(self, item):
+        ''' Returns an item to the list, releasing it if the list is full. '''
+        if len(self.items) < self.size:
+            self.items.append(item)
+        elif self.release is not None:
+            self.release(item)
+
+    def clear(self):
+        ''' Releases all the free items. '''
+        items, self.items = self.items, []
+        if self.release is not None:
+            for item in items:
+                self.release(item)
+
+    def stats(self):
+        return dict(size=self.size, free=len(self.items),
+                    hits=self.hits, misses=self.misses)
+
+
+# The stack of active arenas, per thread
+_arenas = threading.local()
+
+
+def _new(ffi, ctype, init=None, allocator=None, origin='other', name=None):
+    ''' ffi.new() for the temporary allocations made by wrapped calls, which
+    come from the innermost active ``arena`` if there is one, otherwise from
+    ``allocator`` or the default allocator. ``origin`` and ``name`` tag the
+    allocation when accounting is on, see ``track_allocations``. '''
+
+    stack = getattr(_arenas, 'stack', None)
+    if stack:
+        return stack[-1].new(ffi, ctype, init)
+    if allocator is None:
+        allocator = _default_allocator
+        if allocator is None:
+            cdata = ffi.new(ctype, init)
+            if _alloc_sites is not None:
+                _track(ffi, cdata, origin, name)
+            return cdata
+    if not isinstance(ctype, ffi.CType):
+        # The allocator may come from a different FFI which can't parse
+        # this FFI's type names.
+        ctype = ffi.typeof(ctype)
+    cdata = allocator(ctype, init)
+    if _alloc_sites is not None:
+        _track(ffi, cdata, origin, name)
+    return cdata
+
+
+class AllocSite(object):
+    ''' Native allocation counters for one origin and function, see
+    ``track_allocations``.
+
+    * ``live``: Bytes currently allocated.
+    * ``peak``: High-water mark of ``live``.
+    * ``count``: Allocations currently alive.
+    * ``allocs``: Total allocations made.
+    * ``total``: Total bytes allocated.
+
+    '''
+
+    __slots__ = ('live', 'peak', 'count', 'allocs', 'total')
+
+    def __init__(self):
+        self.live = self.peak = self.count = self.allocs = self.total = 0
+
+    def _alloc(self, nbytes):
+        self.live += nbytes
+        self.count += 1
+        self.allocs += 1
+        self.total += nbytes
+        if self.live > self.peak:
+            self.peak = self.live
+
+    def _free(self, nbytes):
+        self.live -= nbytes
+        self.count -= 1
+
+    def as_dict(self):
+        return {'live': self.live, 'peak': self.peak, 'count': self.count,
+                'allocs': self.allocs, 'total': self.total}
+
+
+# (origin, name) -> AllocSite while accounting is on, see track_allocations()
+_alloc_sites = None
+_alloc_total = AllocSite()
+
+
+def _track(ffi, cdata, origin, name, nbytes=None):
+    # Counts cdata against its site until it's garbage collected
+    if nbytes is None:
+        ctype = ffi.typeof(cdata)
+        nbytes = ffi.sizeof(ctype.item) if ctype.kind == 'pointer' else ffi.sizeof(cdata)
+    key = (origin, name)
+    site = _alloc_sites.get(key)
+    if site is None:
+        site = _alloc_sites[key] = AllocSite()
+    site._alloc(nbytes)
+    _alloc_total._alloc(nbytes)
+    weakref.finalize(cdata, _untrack, site, _alloc_total, nbytes)
+    return cdata
+
+
+def _untrack(site, total, nbytes):
+    site._free(nbytes)
+    total._free(nbytes)
+
+
+def track_allocations(enabled=True):
+    ''' Turns accounting of the native memory allocated by cfficloak on or off.
+
+    While on, every allocation made by the module is tagged with its origin
+    and the function or type responsible, and counted until it's freed:
+
+    * ``'string'``, ``'outarg'``, ``'array'``: Temporary arguments made by
+      ``CFunction`` calls, tagged with the function name.
+    * ``'struct'``, ``'struct_array'``, ``'stream'``: ``CStructType`` calls,
+      arrays and stream buffers, tagged with the struct name. Pooled structs
+      are counted once, when they're first allocated.
+    * ``'carray'``, ``'nparray'``: Tagged with the C type, or None.
+    * ``'arena'``: Arena blocks. Allocations from an arena aren't counted
+      separately.
+
+    Memory allocated by the wrapped library itself isn't seen. Allocations
+    made while accounting was off are never counted, and the counts are kept
+    when it's turned off, see ``allocation_stats``.
+
+    '''
+    global _alloc_sites
+    if enabled:
+        if _alloc_sites is None:
+            _alloc_sites = {}
+    else:
+        _alloc_sites = None
+
+
+def allocation_stats(reset=False):
+    ''' Returns a snapshot of the native allocation accounting, see
+    ``track_allocations``: a dict with the overall ``'total'`` counters and a
+    ``'sites'`` dict of counters keyed by ``(origin, name)``, both as returned
+    by ``AllocSite.as_dict``.
+
+    With ``reset``, sites with no live allocations are dropped and the
+    allocation totals and peaks of the rest restart from their live values.
+
+    '''
+    sites = _alloc_sites or {}
+    snapshot = {'total': _alloc_total.as_dict(),
+                'sites': {key: site.as_dict() for key, site in list(sites.items())}}
+    if reset:
+        for key, site in list(sites.items()):
+            if not site.count:
+                del sites[key]
+        for site in list(sites.values()) + [_alloc_total]:
+            site.allocs = site.count
+            site.total = site.peak = site.live
+    return snapshot
+
+
+# Used in place of ffi.new() when no allocator is given, see set_allocator()
+_default_allocator = None
+
+
+def allocator(alloc=None, free=None, should_clear_after_alloc=True, ffi=None):
+    ''' Creates an allocator with ``ffi.new_allocator``, to pass as the
+    ``allocator`` argument of ``carray``, ``CStructType.array`` and
+    ``cmethod`` or to ``set_allocator``.
+
+    * ``alloc``, ``free``: Optional malloc/free pair, e.g. exported by the
+      wrapped library. Both C functions and ``CFunction`` objects are accepted.
+      By default cffi's own allocation is used.
+    * ``should_clear_after_alloc``: Set to False to skip zeroing the memory,
+      for buffers the C code is going to overwrite anyway.
+    * ``ffi``: The FFI to create the allocator with, defaults to the global FFI.
+
+    '''
+
+    if isinstance(alloc, CFunction):
+        alloc = alloc.cfunc
+    if isinstance(free, CFunction):
+        free = free.cfunc
+    ffi = ffi if ffi is not None else _globalffi()
+    return ffi.new_allocator(alloc=alloc, free=free,
+                             should_clear_after_alloc=should_clear_after_alloc)
+
+
+def set_allocator(allocator):
+    ''' Sets the module default allocator used for ``carray``,
+    ``CStructType.array`` and wrapped call arguments when none is given.
+    Pass None to go back to plain ``ffi.new``. '''
+
+    global _default_allocator
+    _default_allocator = allocator
+
+
+class MmapAllocator(object):
+    ''' Allocation backend for large buffers, built on ``mmap`` instead of
+    malloc. Pass an instance as the ``allocator`` argument of ``carray``,
+    ``CStructType.array`` and ``cmethod`` or to ``set_allocator``.
+
+    Each allocation is its own mapping, returned as a cffi array (or pointer)
+    from ``ffi.from_buffer`` which keeps the mapping alive. The mapping is
+    unmapped when the array is garbage collected.
+
+    * ``path``: Optional file to map instead of anonymous memory. The file is
+      created or grown to fit and every allocation maps it from the start, so
+      the contents persist and can be shared with other processes mapping it.
+    * ``hugepages``: Advise the kernel to back the mapping with transparent
+      hugepages (``MADV_HUGEPAGE``) where supported. Anonymous allocations of
+      at least one hugepage are rounded up to a whole number of hugepages and
+      start on a hugepage boundary, by over-mapping by one hugepage and
+      returning the aligned part. File-backed mappings always start at the
+      beginning of the file so aren't aligned, and mostly won't get
+      hugepages.
+    * ``prefault``: Fault in every page up front (``MAP_POPULATE`` where
+      supported) rather than on first touch.
+
+    '''
+
+    hugepage_size = 2 << 20
+
+    def __init__(self, path=None, hugepages=True, prefault=False, ffi=None):
+        self.path = path
+        self.hugepages = hugepages
+        self.prefault = prefault
+        self.ffi = ffi if ffi is not None else _globalffi()
+
+    def __call__(self, ctype, init=None):
+        ffi = self.ffi
+        if not isinstance(ctype, ffi.CType):
+            ctype = ffi.typeof(ctype)
+
+        if ctype.kind == 'pointer':
+            nbytes = ffi.sizeof(ctype.item)
+        else:
+            length = ctype.length
+            if length is None:
+                length = init if isinstance(init, _integer_types) else len(init)
+                ctype = ffi.typeof(ffi.getctype(ctype.item, '[%i]' % length))
+            nbytes = ffi.sizeof(ctype)
+            if isinstance(init, _integer_types):
+                init = None
+
+        if self.hugepages and self.path is None and nbytes >= self.hugepage_size:
+            buff = self._map_aligned(nbytes)
+        else:
+            buff = self.map(nbytes)
+        cdata = ffi.from_buffer(ctype, buff, require_writable=True)
+        if init is not None:
+            if ctype.kind == 'pointer':
+                cdata[0] = init
+            else:
+                cdata[0:len(init)] = init
+        return cdata
+
+    def _map_aligned(self, nbytes):
+        # Transparent hugepages are only used for hugepage aligned ranges,
+        # but mmap only aligns to pages. Map an extra hugepage and return a
+        # view of the aligned part, which keeps the mapping alive.
+        size = self.hugepage_size
+        nbytes = -(-nbytes // size) * size
+        mapping = self.map(nbytes + size)
+        addr = int(self.ffi.cast('uintptr_t', self.ffi.from_buffer(mapping)))
+        offset = -addr % size
+        if self.prefault and hasattr(mmap, 'MADV_DONTNEED'):
+            # Give back the prefaulted pages either side
+            if offset:
+                mapping.madvise(mmap.MADV_DONTNEED, 0, offset)
+            mapping.madvise(mmap.MADV_DONTNEED, offset + nbytes,
+                            len(mapping) - offset - nbytes)
+        return memoryview(mapping)[offset:offset + nbytes]
+
+    def map(self, nbytes):
+        ''' Returns a new writable ``mmap`` of at least ``nbytes``. '''
+
+        if self.hugepages and nbytes >= self.hugepage_size:
+            nbytes = -(-nbytes // self.hugepage_size) * self.hugepage_size
+        nbytes = max(nbytes, 1)
+        populate = getattr(mmap, 'MAP_POPULATE', 0) if self.prefault else 0
+
+        if self.path is None:
+            if hasattr(mmap, 'MAP_ANONYMOUS'):
+                flags = mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | populate
+                mapping = mmap.mmap(-1, nbytes, flags=flags)
+            else:
+                mapping = mmap.mmap(-1, nbytes)
+        else:
+            with open(self.path, 'a+b') as f:
+                if os.fstat(f.fileno()).st_size < nbytes:
+                    f.truncate(nbytes)
+                if hasattr(mmap, 'MAP_SHARED'):
+                    mapping = mmap.mmap(f.fileno(), nbytes, flags=mmap.MAP_SHARED | populate)
+                else:
+                    mapping = mmap.mmap(f.fileno(), nbytes)
+
+        if self.hugepages and hasattr(mmap, 'MADV_HUGEPAGE'):
+            try:
+                mapping.madvise(mmap.MADV_HUGEPAGE)
+            except OSError:
+                pass  # e.g. transparent hugepages disabled in the kernel
+        if self.prefault and not populate:
+            for offset in range(0, nbytes, mmap.PAGESIZE):
+                mapping[offset] = mapping[offset]
+        return mapping
+
+
+def _aligned_new(ffi, arraytype, align, allocator=None, origin='array', name=None):
+    ''' Allocates a C array of the fixed size ``arraytype`` whose first item
+    is on an ``align`` byte boundary, by over-allocating a char buffer. The
+    returned array keeps that buffer alive. '''
+
+    if align <= 0:
+        raise ValueError('align must be a positive number of bytes')
+    nbytes = ffi.sizeof(arraytype)
+    new = allocator or _default_allocator or ffi.new
+    # Typed with this FFI, as the allocator may come from another one
+    owner = new(ffi.typeof('char[]'), nbytes + align - 1)
+    offset = -int(ffi.cast('uintptr_t', owner)) % align
+    view = memoryview(ffi.buffer(owner))[offset:offset + nbytes]
+    cdata = ffi.from_buffer(arraytype, view, require_writable=True)
+    if _alloc_sites is not None:
+        _track(ffi, cdata, origin, name, nbytes + align - 1)
+    return cdata
+
+
+def _aligned_ndarray(shape, dtype, align):
+    ''' numpy.empty() with the data aligned to ``align`` bytes. The returned
+    array is a view which keeps the over-allocated buffer alive. '''
+
+    numpy = _numpy()
+    dtype = numpy.dtype(dtype)
+    count = int(numpy.prod(shape))
+    buff = numpy.empty(count * dtype.itemsize + align - 1, dtype=numpy.uint8)
+    offset = -buff.__array_interface__['data'][0] % align
+    return buff[offset:offset + count * dtype.itemsize].view(dtype).reshape(shape)
+
+
+class Arena(object):
+    ''' A bump allocator for the temporary arguments of wrapped C calls.
+
+    While an arena is active (see ``arena``), the out/in-out pointers,
+    strings and list-converted arrays created by ``CFunction`` calls are
+    carved out of one large zeroed block instead of each being a separate
+    ``ffi.new``. Everything is freed at once when the arena is closed, so
+    arrays returned from calls made inside the block must not be used after
+    it.
+
+    * ``size``: Size in bytes of each block. Allocations which don't fit in
+      the current block get a new one of at least this size.
+
+    '''
+
+    align = 16
+
+    def __init__(self, size=65536, ffi=None):
+        self.size = size
+        self.ffi = ffi if ffi is not None else _globalffi()
+        self.blocks = []
+        self.used = 0  # Bytes handed out
+        self._base = None
+        self._offset = 0
+        self._end = 0
+
+    def _reserve(self, nbytes, align):
+        offset = (self._offset + align - 1) & ~(align - 1)
+        if self._base is None or offset + nbytes > self._end:
+            size = max(self.size, nbytes)
+            block = self.ffi.new('char[]', size)
+            if _alloc_sites is not None:
+                _track(self.ffi, block, 'arena', None)
+            self.blocks.append(block)
+            self._base = self.ffi.cast('char *', block)
+            offset, self._end = 0, size
+        self._offset = offset + nbytes
+        self.used += nbytes
+        return self._base + offset
+
+    def new(self, ffi, ctype, init=None):
+        ''' Same as ``ffi.new(ctype, init)``, but allocated from the arena.
+        Arrays are returned as a sized view over a pointer to their items. '''
+
+        if not isinstance(ctype, ffi.CType):
+            ctype = ffi.typeof(ctype)
+        item = ctype.item
+
+        if ctype.kind == 'pointer':
+            ptr = ffi.cast(ctype, self._reserve(ffi.sizeof(item), ffi.alignof(item)))
+            if init is not None:
+                ptr[0] = init
+            return ptr
+
+        length = ctype.length
+        if length is None:
+            if isinstance(init, _integer_types):
+                length, init = init, None
+            elif isinstance(init, (_binary_type, _text_type)):
+                length = len(init) + 1  # Leave room for the terminator
+            else:
+                init = list(init)
+                length = len(init)
+
+        ptrtype = _ptrtypes.get(item)
+        if ptrtype is None:
+            ptrtype = _ptrtypes[item] = ffi.typeof(ffi.getctype(item, '*'))
+        ptr = ffi.cast(ptrtype, self._reserve(ffi.sizeof(item) * length, ffi.alignof(item)))
+        if isinstance(init, _binary_type):
+            ffi.memmove(ptr, init, len(init))
+        elif init:
+            ptr[0:len(init)] = list(init) if isinstance(init, _text_type) else init
+        return ptr[0:length]
+
+    def close(self):
+        ''' Frees every block. '''
+        release = getattr(self.ffi, 'release', None)
+        for block in self.blocks:
+            if release is not None:
+                release(block)
+        self.blocks = []
+        self._base = None
+        self._offset = self._end = 0
+
+    def __enter__(self):
+        stack = getattr(_arenas, 'stack', None)
+        if stack is None:
+            stack = _arenas.stack = []
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _arenas.stack.remove(self)
+        self.close()
+
+
+# Pointer ctypes for arena allocated arrays, by item ctype
+_ptrtypes = {}
+
+
+def arena(size=65536):
+    ''' Returns an ``Arena`` to use as a context manager, backing all the
+    temporary allocations made by wrapped calls in the block::
+
+        >>> with cfficloak.arena():
+        ...     for point in points:
+        ...         complicated(point, 8, 3.14)
+
+    '''
+    return Arena(size)
+
+
+def pool_stats():
+    ''' Returns a snapshot of the hit/miss counters of every pool, keyed by
+    ``'struct:'`` plus the struct type name and a number telling apart
+    ``CStructType`` objects for the same struct, e.g. ``'struct:point_t#1'``, or the
+    CObject class's module and qualified name, e.g. ``'mymodule.Point'``. '''
+    return {name: pool.stats() for name, pool in _pools.items()}
+
+
 class CFunction(object):
     ''' Adds some low-ish-level introspection to CFFI C functions.
 
@@ -151,10 +770,24 @@ class CFunction(object):
     * ``args``: From typeof.
     * ``kind``: From typeof.
     * ``result``: From typeof.
+    * ``name``: The C function's name.
+    * ``destructor``: C function attached to returned pointers, see
+      ``set_destructor``.
+    * ``stats``: ``CallStats`` for the function once statistics have been
+      enabled, see ``enable_stats``.
 
     Callable: when called, the cfunc is called directly and it's result
     is returned. See ``cmethod`` for more uses.
 
+    How the result is post-processed is decided once here, from the return
+    ctype, rather than on every call:
+
+    * pointer returns are checked for NULL by ``checkerr``
+    * ``char *`` returns are converted with ``ffi.string`` (NULL is left as-is
+      so the check above still raises)
+    * enum returns are converted to their cached ``Enum`` instances
+    * scalar, struct and void returns are passed through with no check
+
     '''
 
     def __init__(self, ffi, cfunc):
@@ -172,6 +805,19 @@ class CFunction(object):
         self.cname = self.typeof.cname
         self.kind = self.typeof.kind
         self.result = self.typeof.result
+        self.name = getattr(cfunc, '__name__', self.cname)
+        self.destructor = None
+        self.stats = None
+        self._ccall = cfunc
+        self._hooks = ()
+        self._history = None
+        _cfunctions.add(self)
+
+        self._convert = self._result_converter(ffi, self.result)
+        if type(self).checkerr is not CFunction.checkerr or self.result.kind == 'pointer':
+            self._checkerr = self.checkerr
+        else:
+            self._checkerr = None
 
         # TODO Profile to see if this is really much faster...
         #self.__call__ = func
@@ -206,6 +852,9 @@ class CFunction(object):
 
         outargs = kwargs.get('outargs')
         retargs = kwargs.get('retargs')
+        allocator = kwargs.get('allocator')
+        align = kwargs.get('align')
+        copyback = None
         cargs = self.args
 
 
@@ -217,17 +866,21 @@ class CFunction(object):
                     args = args[:argi] + (arg._cdata,) + args[argi+1:]
                 elif arg is None:
                     args = args[:argi] + (self.ffi.NULL,) + args[argi + 1:]
-                elif isinstance(arg, six.text_type):
+                elif isinstance(arg, _text_type):
                     if 'wchar' in self.args[argi].cname:
-                        arg = self.ffi.new('wchar[]', arg)
+                        arg = _new(self.ffi, 'wchar_t[]', arg, allocator,
+                                   'string', self.name)
                     elif 'char' in self.args[argi].cname:
-                        arg = self.ffi.new('char[]', arg.encode())
+                        arg = _new(self.ffi, 'char[]', arg.encode(), allocator,
+                                   'string', self.name)
                     args = args[:argi] + (arg,) + args[argi + 1:]
-                elif isinstance(arg, six.binary_type):
+                elif isinstance(arg, _binary_type):
                     if 'wchar' in self.args[argi].cname:
-                        arg = self.ffi.new('wchar[]', arg.decode())
+                        arg = _new(self.ffi, 'wchar_t[]', arg.decode(), allocator,
+                                   'string', self.name)
                     elif 'char' in self.args[argi].cname:
-                        arg = self.ffi.new('char[]', arg)
+                        arg = _new(self.ffi, 'char[]', arg, allocator,
+                                   'string', self.name)
                     args = args[:argi] + (arg,) + args[argi + 1:]
                 elif isinstance(arg, self.ffi.CData) and self.ffi.typeof(arg) != cargs[argi]:
                     if cargs[argi].kind == 'pointer' and cargs[argi].item == self.ffi.typeof(arg):
@@ -247,39 +900,53 @@ class CFunction(object):
             # A few optimizations because looking up local variables is much
             # faster than looking up object attributes.
             retvals_append = retvals.append
-            cfunc = self.cfunc
             ffi = self.ffi
 
             for argi, inout in outargs:
                 argtype = cargs[argi]
                 if inout == 'o':
-                    inptr = ffi.new(argtype.cname)
+                    inptr = _new(ffi, argtype, None, allocator, 'outarg', self.name)
                     args = args[:argi] + (inptr,) + args[argi:]
                 elif inout == 'x':
-                    if ffi.typeof(args[argi]) == argtype:
+                    if isinstance(args[argi], ffi.CData) and ffi.typeof(args[argi]) == argtype:
                         inptr = args[argi]
                     else:
-                        inptr = ffi.new(argtype.cname, args[argi])
+                        inptr = _new(ffi, argtype, args[argi], allocator, 'outarg', self.name)
                     args = args[:argi] + (inptr,) + args[argi+1:]
                 elif inout == 'a':
-                    inptr = self.get_arrayptr(args[argi], ctype=argtype)
+                    if align and copyback is None:
+                        copyback = []
+                    copies = len(copyback) if copyback is not None else 0
+                    array = args[argi]
+                    inptr = self.get_arrayptr(array, ctype=argtype, allocator=allocator,
+                                              align=align, unaligned=kwargs.get('unaligned'),
+                                              copyback=copyback)
                     args = args[:argi] + (inptr,) + args[argi+1:]
+                    if copyback and len(copyback) > copies:
+                        # The scratch space is freed after the call, so return
+                        # a pointer in to the caller's array like when it's
+                        # passed directly.
+                        inptr = ffi.cast('void *', array.__array_interface__['data'][0])
                 retvals_append((inptr, inout))
 
-        retval = self.cfunc(*args)
+        # The C function itself, or a timing wrapper when stats are enabled
+        retval = self._ccall(*args)
 
-        if self.result.kind == 'enum':
-            retval = wrapenum(retval, self.result)
+        if copyback:
+            # Copy results from aligned scratch buffers back in to the
+            # caller's numpy arrays.
+            for scratch, array in copyback:
+                array[...] = scratch
 
-        elif self.result.cname == 'char *':
-            retval = self.ffi.string(retval)
+        if self._convert is not None:
+            retval = self._convert(retval)
 
         # This is a tad slower in pypy but substantially faster in cpython than
         # checkerr = kwargs.get('checkerr'); if checkerr is not None: ...
         if 'checkerr' in kwargs and kwargs['checkerr'] is not None:
             retval = kwargs['checkerr'](self, args, retval)
-        else:
-            retval = self.checkerr(self, args, retval)
+        elif self._checkerr is not None:
+            retval = self._checkerr(self, args, retval)
 
         if retvals:
             retval = (retval,)  # Return tuples, because it's prettier :)
@@ -293,7 +960,8 @@ class CFunction(object):
 
         return retval
 
-    def get_arrayptr(self, array, ctype=None):
+    def get_arrayptr(self, array, ctype=None, allocator=None, align=None,
+                     unaligned='copy', copyback=None):
         ''' Get a CFFI compatible pointer object for an array.
 
         Supported ``array`` types are:
@@ -314,23 +982,162 @@ class CFunction(object):
           ``ctype`` must be provided (CFunction's __call__ method does this
           automatically).
 
+        New arrays are created with ``allocator`` if given (see
+        ``allocator()``), or the module default allocator.
+
+        If ``align`` is given, numpy arrays must have their data aligned to that
+        many bytes. Misaligned arrays raise ``ValueError`` if ``unaligned`` is
+        ``'raise'``. Otherwise they are copied in to aligned scratch space and
+        ``(scratch, array)`` is appended to ``copyback``, so the caller can copy
+        the results back after the C call. New arrays are allocated aligned.
+
         '''
 
-        if numpy and isinstance(array, numpy.ndarray):
-            return self.ffi.cast('void *',
-                                 array.__array_interface__['data'][0])
+        if _isndarray(array):
+            addr = array.__array_interface__['data'][0]
+            if align and addr % align:
+                if unaligned == 'raise' or copyback is None:
+                    raise ValueError('numpy array data at 0x{0:x} is not aligned to '
+                                     '{1} bytes'.format(addr, align))
+                scratch = _aligned_ndarray(array.shape, array.dtype, align)
+                scratch[...] = array
+                copyback.append((scratch, array))
+                addr = scratch.__array_interface__['data'][0]
+            return self.ffi.cast('void *', addr)
         elif isinstance(array, self.ffi.CData):
             return array
         else:
+            if align:
+                items = None if isinstance(array, _integer_types) else list(array)
+                length = array if items is None else len(items)
+                arr = _aligned_new(self.ffi, self.ffi.getctype(ctype.item.cname, '[%i]' % length),
+                                   align, allocator, 'array', self.name)
+                if items:
+                    arr[0:length] = items
+                return arr
             # Assume it's an iterable or int/long. CFFI will handle the rest.
-            return self.ffi.new(self.ffi.getctype(ctype.item.cname, '[]'),
-                                array)
+            return _new(self.ffi, self.ffi.getctype(ctype.item.cname, '[]'),
+                        array, allocator, 'array', self.name)
+
+    def enable_stats(self):
+        ''' Starts recording ``CallStats`` for this function.
+
+        The function's class is swapped for an instrumented subclass and the
+        C call for a timed one, so the normal call path is left untouched
+        while stats are off.
+
+        '''
+        if self.stats is None:
+            self.stats = CallStats()
+        self._ccall = _timed_ccall(self.cfunc, self.stats)
+        self._instrument()
+
+    def disable_stats(self):
+        ''' Stops recording stats, restoring the normal call path. The
+        counts so far are kept in ``stats``. '''
+        self._ccall = self.cfunc
+        self._instrument()
+
+    def add_hook(self, hook):
+        ''' Adds a ``Hook`` to be run around sampled calls of this function.
+        See ``add_hook()``. '''
+        if hook not in self._hooks:
+            self._hooks = self._hooks + (hook,)
+            hook._cfuncs.add(self)
+            self._instrument()
+
+    def remove_hook(self, hook):
+        ''' Removes a ``Hook`` added by ``add_hook``. '''
+        self._hooks = tuple(h for h in self._hooks if h is not hook)
+        hook._cfuncs.discard(self)
+        self._instrument()
+
+    def _instrument(self):
+        # Picks the class for the instrumentation which is on, so each call
+        # only pays for what's enabled.
+        base = getattr(type(self), '_cbase', type(self))
+        mixins = ()
+        if self._hooks:
+            mixins += (_HookedCFunction,)
+        if self._history is not None:
+            mixins += (_RecordedCFunction,)
+        if self._ccall is not self.cfunc:
+            mixins += (_StatsCFunction,)
+        self.__class__ = _instrumented_class(base, mixins)
+
+    def set_destructor(self, cdel):
+        ''' Declares ``cdel`` as the destructor for pointers returned by this
+        function, i.e. pairs a ``make_point``-style constructor with its
+        ``del_point``.
+
+        Non-NULL pointers returned from then on have ``cdel`` attached with
+        ``ffi.gc`` so they're freed once no longer referenced, and pointers to
+        structs or unions are returned wrapped in a ``CStruct``/``CUnion``.
+        Don't call ``cdel`` on these pointers yourself.
+
+        * ``cdel``: A ``CFunction`` (or raw CFFI function) taking the pointer.
+
+        '''
+
+        if self.result.kind != 'pointer':
+            raise TypeError('{0} does not return a pointer, it can not have '
+                            'a destructor'.format(self.cname))
+        if isinstance(cdel, CFunction):
+            cdel = cdel.cfunc
+
+        ffi = self.ffi
+        gc = ffi.gc
+        NULL = ffi.NULL
+        kind = self.result.item.kind
+        wrapper = CStruct if kind == 'struct' else CUnion if kind == 'union' else None
+
+        if wrapper is None:
+            def convert(retval):
+                return retval if retval == NULL else gc(retval, cdel)
+        else:
+            def convert(retval):
+                if retval == NULL:
+                    return retval
+                retval = wrapper(ffi, gc(retval, cdel))
+                if _live_objects is not None:
+                    _track_object(retval, retval._cname)
+                return retval
+
+        self._convert = convert
+        self.destructor = cdel
+
+    @staticmethod
+    def _result_converter(ffi, result):
+        ''' Picks the conversion applied to every return value of a C function
+        with the given result ctype, or None if it's returned as-is. '''
+
+        if result.kind == 'enum':
+            enum = _enumtype(result)
+            values = enum._values
+
+            def convert(retval):
+                try:
+                    return values[retval]
+                except KeyError:
+                    return enum(retval)
+            return convert
+
+        elif result.cname == 'char *':
+            string = ffi.string
+            NULL = ffi.NULL
+
+            def convert(retval):
+                return retval if retval == NULL else string(retval)
+            return convert
+
+        return None
 
     def checkerr(self, cfunc, args, retval):
-        ''' Default error checker. Checks for NULL return values and raises
-        NullError.
+        ''' Default error checker for pointer returns. Checks for NULL return
+        values and raises NullError.
 
-        Can be overridden by subclasses. If ``_checkerr`` returns anything
+        Can be overridden by subclasses, in which case it is used for every
+        return type. If ``_checkerr`` returns anything
         other than ``None``, that value will be returned by the property or
         method, otherwise original return value of the C call will be returned.
         Also useful for massaging returned values.
@@ -343,17 +1150,43 @@ class CFunction(object):
         #    self._checkerr(cfunc, args, retval)
 
         if retval == self.ffi.NULL:
-            raise NullError('NULL returned by {0} with args {1}. '
-                            .format(cfunc.cname, args))
+            raise NullError(cfunc, args)
         else:
             return retval
 
 
+def errnocheck(failed=None):
+    ''' Creates an error checker which raises ``ErrnoError`` with the value of
+    ``ffi.errno`` when a C function reports failure.
+
+    * ``failed``: Optional predicate called with the return value, returning
+      True when the call failed. By default NULL pointer returns and integer
+      returns of -1 are treated as failures, as per the usual libc convention.
+
+    Use it anywhere a ``checkerr`` is accepted, e.g.::
+
+        >>> read = cmethod(libc.read, checkerr=errnocheck())
+
+    '''
+
+    if failed is None:
+        def failed(retval):
+            if isinstance(retval, (int, long)):
+                return retval == -1
+            return retval == cffi.FFI.NULL
+
+    def checkerr(cfunc, args, retval):
+        if failed(retval):
+            raise ErrnoError(cfunc.ffi.errno, cfunc, args)
+        return retval
+    return checkerr
+
+
 def wrap(ffi, cobj):
     '''
     Convenience function to wrap CFFI functions structs and unions.
     '''
-    if (isinstance(cobj, collections.Callable)
+    if (isinstance(cobj, collections_abc.Callable)
         and ffi.typeof(cobj).kind == 'function'):
         cobj = CFunction(ffi, cobj)
 
@@ -374,7 +1207,621 @@ def wrap(ffi, cobj):
     return cobj
 
 
-def wrapall(ffi, api):
+class CallStats(object):
+    ''' Call statistics for one C function, see ``CFunction.enable_stats``.
+
+    * ``calls``: Number of calls.
+    * ``errors``: Number of calls which raised, including from ``checkerr``.
+    * ``total``: Cumulative wall time of the calls, in seconds.
+    * ``max``: Longest single call, in seconds.
+    * ``ctime``: Time spent in the C function itself. The rest of ``total``
+      is argument and result marshalling, see ``marshal``.
+
+    '''
+
+    __slots__ = ('calls', 'errors', 'total', 'max', 'ctime')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = self.errors = 0
+        self.total = self.max = self.ctime = 0.0
+
+    @property
+    def marshal(self):
+        return self.total - self.ctime
+
+    def as_dict(self):
+        return {'calls': self.calls, 'errors': self.errors, 'total': self.total,
+                'max': self.max, 'ctime': self.ctime, 'marshal': self.marshal}
+
+
+_cfunctions = weakref.WeakSet()
+_instrumented_classes = {}
+
+
+class _StatsCFunction(object):
+    # Mixed in ahead of CFunction (or a subclass of it) while stats are on
+    def __call__(self, *args, **kwargs):
+        stats = self.stats
+        start = _clock()
+        try:
+            return super(_StatsCFunction, self).__call__(*args, **kwargs)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = _clock() - start
+            stats.calls += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+
+
+class _HookedCFunction(object):
+    # Mixed in while any hooks are added
+    def __call__(self, *args, **kwargs):
+        sampled = [hook for hook in self._hooks if hook.sample()]
+        if not sampled:
+            return super(_HookedCFunction, self).__call__(*args, **kwargs)
+
+        call = HookedCall(self, args)
+        for hook in sampled:
+            if hook.before is not None:
+                hook.before(call)
+        start = _clock()
+        try:
+            call.result = super(_HookedCFunction, self).__call__(*args, **kwargs)
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            call.elapsed = _clock() - start
+            for hook in sampled:
+                if hook.after is not None:
+                    hook.after(call)
+
+
+class _RecordedCFunction(object):
+    # Mixed in while a CallHistory is recording
+    def __call__(self, *args, **kwargs):
+        history = self._history
+        slot = history._record(self, args, kwargs.get('outargs'))
+        try:
+            retval = super(_RecordedCFunction, self).__call__(*args, **kwargs)
+        except Exception as ex:
+            history._set(slot * history._width, _HIST_ERROR, type(ex).__name__)
+            raise
+        history._setvalue(self.ffi, slot * history._width, retval[0] if type(retval) is tuple else retval)
+        return retval
+
+
+def _instrumented_class(base, mixins):
+    if not mixins:
+        return base
+    cls = _instrumented_classes.get((base, mixins))
+    if cls is None:
+        cls = type(base.__name__, mixins + (base,), {'_cbase': base})
+        _instrumented_classes[(base, mixins)] = cls
+    return cls
+
+
+def _timed_ccall(cfunc, stats):
+    def ccall(*args):
+        start = _clock()
+        try:
+            return cfunc(*args)
+        finally:
+            stats.ctime += _clock() - start
+    return ccall
+
+
+def _cfunc_targets(cfuncs):
+    if cfuncs is None:
+        return list(_cfunctions)
+    if isinstance(cfuncs, dict):
+        cfuncs = cfuncs.values()
+    elif isinstance(cfuncs, CFunction) or hasattr(cfuncs, 'cfunc'):
+        cfuncs = [cfuncs]
+    # cmethod wrappers carry their CFunction
+    cfuncs = [getattr(cfunc, 'cfunc', None) if not isinstance(cfunc, CFunction) else cfunc
+              for cfunc in cfuncs]
+    return [cfunc for cfunc in cfuncs if isinstance(cfunc, CFunction)]
+
+
+class HookedCall(object):
+    ''' The call passed to ``Hook`` callbacks.
+
+    * ``cfunc``: The ``CFunction`` called.
+    * ``name``: Its name.
+    * ``args``: The positional arguments it was called with.
+    * ``result``: The return value, set before ``after`` runs.
+    * ``error``: The exception raised, if any, set before ``after`` runs.
+    * ``elapsed``: Wall time of the call in seconds, set before ``after`` runs.
+    * ``data``: Free for ``before`` to pass something on to ``after``, e.g. a
+      tracing span.
+
+    '''
+
+    __slots__ = ('cfunc', 'name', 'args', 'result', 'error', 'elapsed', 'data')
+
+    def __init__(self, cfunc, args):
+        self.cfunc = cfunc
+        self.name = cfunc.name
+        self.args = args
+        self.result = self.error = self.elapsed = self.data = None
+
+    def summary(self, width=40):
+        ''' A short, single line string of the arguments. C data is shown as
+        its type and address rather than its contents. '''
+        parts = []
+        for arg in self.args:
+            arg = getattr(arg, '_cdata', arg)
+            if isinstance(arg, self.cfunc.ffi.CData):
+                ctype = self.cfunc.ffi.typeof(arg)
+                if ctype.kind in ('pointer', 'array'):
+                    arg = '<{0} 0x{1:x}>'.format(ctype.cname, int(self.cfunc.ffi.cast('uintptr_t', arg)))
+                else:
+                    arg = '<{0}>'.format(ctype.cname)
+            else:
+                arg = repr(arg)
+                if len(arg) > width:
+                    arg = arg[:width - 3] + '...'
+            parts.append(arg)
+        return '{0}({1})'.format(self.name, ', '.join(parts))
+
+
+class Hook(object):
+    ''' A pair of callbacks run around sampled calls, see ``add_hook()``.
+
+    * ``before``: Called as ``before(call)`` with a ``HookedCall`` before the
+      C function.
+    * ``after``: Called as ``after(call)`` once the call has returned or
+      raised.
+    * ``every``: Sample every Nth call.
+    * ``probability``: Sample calls at random with this probability instead.
+
+    The sample count is shared by all the functions the hook is added to, so
+    a hook added to a whole namespace sees every Nth call to any of them.
+    Exceptions raised by the callbacks propagate to the caller.
+
+    '''
+
+    def __init__(self, before=None, after=None, every=1, probability=None):
+        if every < 1:
+            raise ValueError('Hook every must be at least 1, got {0}'.format(every))
+        self.before = before
+        self.after = after
+        self.every = every
+        self.probability = probability
+        self._count = 0
+        self._cfuncs = weakref.WeakSet()
+
+    def sample(self):
+        if self.probability is not None:
+            return _random() < self.probability
+        self._count += 1
+        if self._count >= self.every:
+            self._count = 0
+            return True
+        return False
+
+    def remove(self):
+        ''' Removes the hook from every function it was added to. '''
+        for cfunc in list(self._cfuncs):
+            cfunc.remove_hook(self)
+
+
+def add_hook(cfuncs, before=None, after=None, every=1, probability=None):
+    ''' Runs ``before`` and ``after`` around sampled calls to ``cfuncs``, as
+    for ``enable_stats``. Returns the ``Hook``, call its ``remove()`` method
+    to take it off again.
+
+    Calls are sampled every ``every`` calls, or at random with
+    ``probability``, so tracing costs a bounded fraction of calls::
+
+        >>> def trace(call):
+        ...     log.debug('%s -> %r in %.1fus', call.summary(), call.result,
+        ...               call.elapsed * 1e6)
+        >>> hook = cfficloak.add_hook(lib, after=trace, every=100)
+
+    Functions without hooks keep the normal call path.
+
+    '''
+    hook = Hook(before, after, every, probability)
+    for cfunc in _cfunc_targets(cfuncs):
+        cfunc.add_hook(hook)
+    return hook
+
+
+_HIST_NONE, _HIST_INT, _HIST_FLOAT, _HIST_PTR, _HIST_REF, _HIST_PENDING, _HIST_ERROR, \
+    _HIST_ARRAY = range(8)
+
+
+class CallHistory(object):
+    ''' A fixed size ring buffer of the most recent calls, see
+    ``record_calls()``.
+
+    * ``size``: Number of calls kept.
+    * ``maxargs``: Number of arguments kept per call, the rest are dropped.
+    * ``count``: Total number of calls recorded.
+
+    All the storage is allocated up front. A call stores its function name,
+    timestamp, scalar arguments, pointer arguments as addresses, C arrays as
+    their address and size in bytes and ``bytes`` or text arguments by
+    reference. Other arguments (numpy arrays, structs by
+    value, ...) are recorded as ``None``. The entry is written before the C
+    function is called and its result after, so a call which never returned
+    is left marked as pending.
+
+    '''
+
+    def __init__(self, size=1024, maxargs=8):
+        self.size = size
+        self.maxargs = maxargs
+        self.count = 0
+        self._width = width = maxargs + 1  # The result goes first
+        self._counter = itertools.count()
+        self._names = [None] * size
+        self._outargs = [None] * size
+        self._times = array.array('d', [0.0]) * size
+        self._nargs = array.array('B', [0]) * size
+        self._kinds = array.array('B', [0]) * (size * width)
+        self._vals = [None] * (size * width)
+        self._cfuncs = weakref.WeakSet()
+
+    def _record(self, cfunc, args, outargs):
+        n = next(self._counter)
+        self.count = n + 1
+        slot = n % self.size
+        self._names[slot] = cfunc.name
+        self._outargs[slot] = outargs
+        self._times[slot] = _time()
+        base = slot * self._width
+        self._kinds[base] = _HIST_PENDING
+        nargs = min(len(args), self.maxargs)
+        self._nargs[slot] = nargs
+        ffi = cfunc.ffi
+        for i in range(nargs):
+            self._setvalue(ffi, base + 1 + i, args[i])
+        return slot
+
+    def _set(self, index, kind, value):
+        self._kinds[index] = kind
+        self._vals[index] = value
+
+    def _setvalue(self, ffi, index, value):
+        if hasattr(value, '_cdata'):
+            value = value._cdata
+        if value is None:
+            self._set(index, _HIST_NONE, None)
+        elif isinstance(value, _integer_types):
+            self._set(index, _HIST_INT, value)
+        elif isinstance(value, float):
+            self._set(index, _HIST_FLOAT, value)
+        elif isinstance(value, (_binary_type, _text_type)):
+            self._set(index, _HIST_REF, value)
+        elif isinstance(value, ffi.CData) and ffi.typeof(value).kind == 'pointer':
+            self._set(index, _HIST_PTR, int(ffi.cast('uintptr_t', value)))
+        elif isinstance(value, ffi.CData) and ffi.typeof(value).kind == 'array':
+            self._set(index, _HIST_ARRAY, (int(ffi.cast('uintptr_t', value)), ffi.sizeof(value)))
+        else:
+            self._set(index, _HIST_NONE, None)
+
+    @staticmethod
+    def _dumpvalue(kind, value):
+        if kind == _HIST_PTR:
+            return {'ptr': value}
+        if kind == _HIST_ARRAY:
+            return {'ptr': value[0], 'size': value[1]}
+        if kind == _HIST_REF and isinstance(value, _binary_type):
+            return {'bytes': value.decode('latin-1')}
+        if kind == _HIST_INT:
+            return int(value)
+        return value
+
+    def dump(self):
+        ''' Returns the recorded calls, oldest first, as JSON serialisable
+        dicts with ``time``, ``name``, ``args`` and ``result`` keys. Pointers
+        are dumped as ``{'ptr': address}``, C arrays as ``{'ptr': address,
+        'size': bytes}`` and ``bytes`` as ``{'bytes': str}`` (latin-1). Calls which raised have an ``error`` key with the exception
+        type name instead of a result, and calls which haven't returned have
+        ``pending`` set. Calls made with ``cmethod`` out arguments keep them in
+        ``outargs``. '''
+        count = self.count
+        records = []
+        for n in range(max(0, count - self.size), count):
+            slot = n % self.size
+            base = slot * self._width
+            record = {'time': self._times[slot], 'name': self._names[slot],
+                      'args': [self._dumpvalue(self._kinds[base + 1 + i], self._vals[base + 1 + i])
+                               for i in range(self._nargs[slot])]}
+            kind = self._kinds[base]
+            if kind == _HIST_PENDING:
+                record['pending'] = True
+            elif kind == _HIST_ERROR:
+                record['error'] = self._vals[base]
+            else:
+                record['result'] = self._dumpvalue(kind, self._vals[base])
+            if self._outargs[slot]:
+                record['outargs'] = [list(outarg) for outarg in self._outargs[slot]]
+            records.append(record)
+        return records
+
+    def save(self, path):
+        ''' Writes ``dump()`` to ``path`` as JSON, for ``replay()``. '''
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.dump(), f)
+
+    def stop(self):
+        ''' Stops recording, restoring the normal call path. '''
+        for cfunc in list(self._cfuncs):
+            if cfunc._history is self:
+                cfunc._history = None
+                cfunc._instrument()
+        self._cfuncs.clear()
+
+
+def record_calls(cfuncs, size=1024, maxargs=8):
+    ''' Starts recording calls to ``cfuncs``, as for ``enable_stats``, in a new
+    ``CallHistory`` of the last ``size`` calls which is returned. Usually
+    ``cfuncs`` is a whole namespace returned by ``wrapall``::
+
+        >>> history = cfficloak.record_calls(lib)
+        >>> try:
+        ...     run()
+        ... except Exception:
+        ...     history.save('calls.json')
+        ...     raise
+
+    '''
+    history = CallHistory(size, maxargs)
+    for cfunc in _cfunc_targets(cfuncs):
+        cfunc._history = history
+        history._cfuncs.add(cfunc)
+        cfunc._instrument()
+    return history
+
+
+_SKIP_CALL = object()
+
+
+def _replay_arg(cfunc, argi, outargs, value, pointers):
+    if isinstance(value, dict):
+        if 'bytes' in value:
+            return value['bytes'].encode('latin-1')
+        addr = value['ptr']
+        if not addr:
+            return None
+        if addr in pointers:
+            return pointers[addr]
+        # Not from an earlier call in the trace, so use fresh zeroed memory
+        # of the recorded size. Without a size the call can't be made safely.
+        size = value.get('size')
+        if size is None:
+            return _SKIP_CALL
+        ffi = cfunc.ffi
+        skip = [i for i, inout in outargs or () if inout == 'o']
+        cargs = [ctype for i, ctype in enumerate(cfunc.args) if i not in skip]
+        ctype = cargs[argi] if argi < len(cargs) else None
+        if ctype is not None and ctype.kind == 'pointer' and \
+                ctype.item.kind not in ('void', 'opaque', 'function'):
+            itemsize = ffi.sizeof(ctype.item)
+            return ffi.new(ffi.getctype(ctype.item, '[]'), max(1, -(-size // itemsize)))
+        return ffi.new('char[]', max(1, size))
+    return value
+
+
+def replay(trace, cfuncs, repeat=1):
+    ''' Replays a trace of calls saved by ``CallHistory.save`` (a path) or
+    ``CallHistory.dump`` (the records) against the functions in ``cfuncs``, a
+    namespace returned by ``wrapall``, to use a realistic workload as a
+    benchmark.
+
+    Scalar and ``bytes`` arguments are passed as recorded. Pointer arguments
+    which were returned by an earlier call in the trace are replaced with
+    what that call returned this time, so objects are created, used and
+    destroyed as they were. Arrays are replaced with newly allocated zeroed
+    memory of the recorded size. Calls passing any other pointer, whose size
+    isn't known, are skipped, as are calls whose function isn't in
+    ``cfuncs``. Exceptions from calls are counted, not raised.
+
+    Returns a dict with the number of ``calls`` made, ``errors`` raised,
+    ``skipped`` calls and ``elapsed`` wall time in seconds.
+
+    '''
+    if isinstance(trace, _string_types):
+        import json
+        with open(trace) as f:
+            trace = json.load(f)
+    calls = errors = skipped = 0
+    elapsed = 0.0
+    for _ in range(repeat):
+        pointers = {}
+        for record in trace:
+            cfunc = cfuncs.get(record['name'])
+            if not isinstance(cfunc, CFunction) or record.get('pending'):
+                skipped += 1
+                continue
+            outargs = record.get('outargs')
+            args = [_replay_arg(cfunc, i, outargs, value, pointers)
+                    for i, value in enumerate(record['args'])]
+            if any(arg is _SKIP_CALL for arg in args):
+                skipped += 1
+                continue
+            kwargs = {'outargs': [tuple(outarg) for outarg in outargs]} if outargs else {}
+            start = _clock()
+            try:
+                retval = cfunc(*args, **kwargs)
+            except Exception:
+                errors += 1
+                retval = None
+            elapsed += _clock() - start
+            calls += 1
+            result = record.get('result')
+            if isinstance(result, dict) and 'ptr' in result:
+                pointers[result['ptr']] = retval[0] if type(retval) is tuple else retval
+    return {'calls': calls, 'errors': errors, 'skipped': skipped, 'elapsed': elapsed}
+
+
+def enable_stats(cfuncs=None):
+    ''' Enables call statistics on ``cfuncs``: a ``CFunction`` or ``cmethod``
+    wrapper, a list of them, or a namespace returned by ``wrapall``. By default
+    all ``CFunction``\ s are instrumented. See ``CFunction.enable_stats``. '''
+    for cfunc in _cfunc_targets(cfuncs):
+        cfunc.enable_stats()
+
+
+def disable_stats(cfuncs=None):
+    ''' Disables call statistics, as for ``enable_stats``. '''
+    for cfunc in _cfunc_targets(cfuncs):
+        cfunc.disable_stats()
+
+
+def stats(reset=False):
+    ''' Returns a snapshot of the ``CallStats`` of every function which has
+    recorded any, as dicts keyed by function name. Functions of the same name
+    from different libraries are summed. If ``reset`` is True the counters
+    are zeroed after the snapshot. '''
+    snapshot = {}
+    for cfunc in list(_cfunctions):
+        if cfunc.stats is None:
+            continue
+        current = cfunc.stats.as_dict()
+        previous = snapshot.get(cfunc.name)
+        if previous is not None:
+            for key in current:
+                if key == 'max':
+                    current[key] = max(current[key], previous[key])
+                else:
+                    current[key] += previous[key]
+        snapshot[cfunc.name] = current
+        if reset:
+            cfunc.stats.reset()
+    return snapshot
+
+
+class _LiveRef(weakref.ref):
+    __slots__ = ('key', 'typename', 'serial', 'site')
+
+
+# id -> _LiveRef while live objects are tracked, see track_objects()
+_live_objects = None
+_live_serial = 0
+_live_every = 1
+_live_depth = 4
+
+
+def _track_object(obj, typename):
+    global _live_serial
+    _live_serial += 1
+    ref = _LiveRef(obj, _drop_object)
+    ref.key = id(obj)
+    ref.typename = typename
+    ref.serial = _live_serial
+    ref.site = _creation_site() if _live_serial % _live_every == 0 else None
+    _live_objects[ref.key] = ref
+
+
+def _drop_object(ref):
+    live = _live_objects
+    if live is not None and live.get(ref.key) is ref:
+        del live[ref.key]
+
+
+def _untrack_object(obj):
+    ref = _live_objects.get(id(obj))
+    if ref is not None and ref() is obj:
+        del _live_objects[ref.key]
+
+
+_module_file = os.path.splitext(__file__)[0] + '.py'
+
+
+def _creation_site():
+    # The innermost frames outside of this module, innermost first
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == _module_file:
+        frame = frame.f_back
+    site = []
+    while frame is not None and len(site) < _live_depth:
+        code = frame.f_code
+        site.append('{0}:{1} in {2}'.format(code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return ' <- '.join(site)
+
+
+def track_objects(enabled=True, every=1, depth=4):
+    ''' Turns tracking of live native objects on or off.
+
+    While on, ``CObject`` instances of classes with a ``_cdel`` destructor and
+    the structs returned by functions with a destructor (see
+    ``CFunction.set_destructor``) are kept in a registry of weak references
+    until they're garbage collected or closed. Every ``every``\ th object also
+    records where it was created, as the innermost ``depth`` stack frames
+    outside of cfficloak.
+
+    Returns a serial number to pass to ``report_leaks`` as ``since``, to only
+    report the objects created from now on. Turning tracking off drops the
+    registry.
+
+    '''
+    global _live_objects, _live_every, _live_depth
+    if enabled:
+        if _live_objects is None:
+            _live_objects = {}
+        _live_every = max(1, every)
+        _live_depth = depth
+    else:
+        _live_objects = None
+    return _live_serial
+
+
+def live_objects():
+    ''' Returns the number of tracked live native objects by type name, see
+    ``track_objects``. '''
+    counts = {}
+    for ref in list((_live_objects or {}).values()):
+        counts[ref.typename] = counts.get(ref.typename, 0) + 1
+    return counts
+
+
+def report_leaks(since=0, collect=True):
+    ''' Reports the tracked native objects which are still alive, e.g. at the
+    end of a test or periodically in production. See ``track_objects``.
+
+    * ``since``: Only report objects created after ``track_objects`` returned
+      this serial number.
+    * ``collect``: Run the garbage collector first, so objects only kept alive
+      by reference cycles aren't reported.
+
+    Returns a dict keyed by type name of ``{'count': n, 'sites': {site: n}}``,
+    where ``site`` is where the objects were created or None if they weren't
+    sampled. The dict is empty when nothing has leaked::
+
+        >>> start = cfficloak.track_objects()
+        >>> run_test()
+        >>> assert not cfficloak.report_leaks(since=start)
+
+    '''
+    if collect:
+        gc.collect()
+    report = {}
+    for ref in list((_live_objects or {}).values()):
+        if ref.serial <= since or ref() is None:
+            continue
+        leaks = report.get(ref.typename)
+        if leaks is None:
+            leaks = report[ref.typename] = {'count': 0, 'sites': {}}
+        leaks['count'] += 1
+        leaks['sites'][ref.site] = leaks['sites'].get(ref.site, 0) + 1
+    return report
+
+
+def wrapall(ffi, api, owners=None):
     '''
     Convenience function to wrap CFFI functions structs and unions.
 
@@ -383,6 +1830,15 @@ def wrapall(ffi, api):
 
     * ``ffi``: The FFI object (needed for it's ``typeof()`` method)
     * ``api``: As returned by ``ffi.verify()``
+    * ``owners``: Optional dict pairing constructor function names with their
+      destructor, e.g. ``{'make_point': 'del_point'}``. Names may contain a
+      single ``*`` to pair functions by pattern, e.g. ``{'make_*': 'del_*'}``
+      pairs every ``make_X`` with a matching ``del_X``. Functions matching a
+      pattern which don't return a pointer are left alone. See
+      ``CFunction.set_destructor``.
+
+    The first FFI wrapped is registered as ``'default'`` for unpickling, see
+    ``register_ffi``.
 
     Returns a dict mapping object names to wrapper instances. Hint: in
     a python module that only does CFFI boilerplate and verification, etc, try
@@ -396,9 +1852,7 @@ def wrapall(ffi, api):
     # TODO: Support passing in a checkerr function to be called on the
     # return value for all wrapped functions.
 
-    global _global_ffi
-    if _global_ffi is None:
-        _global_ffi = ffi
+    _ffis.setdefault('default', ffi)
 
     cobjs = dotdict()
     for attr in dir(api):
@@ -428,7 +1882,7 @@ def wrapall(ffi, api):
                 try:
                     enumTypeDesc = ffi.typeof(ctypename)
                     enumTypeDesc = enumTypeDesc if enumTypeDesc.kind == 'enum' else enumTypeDesc.args[0]  # This will only succeed for enums
-                    for val, name in six.iteritems(enumTypeDesc.elements):
+                    for val, name in enumTypeDesc.elements.items():
                         cobjs[name] = wrapenum(val, enumTypeDesc)
                 except AttributeError:
                     pass
@@ -446,9 +1900,33 @@ def wrapall(ffi, api):
             elif isinstance(ctype, cffi.model.UnionType):
                 cobjs[ctype.get_c_name()] = CUnionType(ffi, ctype)
 
+    if owners:
+        for cnew, cdel in _match_owners(cobjs, owners):
+            cnew.set_destructor(cdel)
+
     return cobjs
 
 
+def _match_owners(cobjs, owners):
+    ''' Yields (constructor, destructor) CFunction pairs from the ``owners``
+    argument of ``wrapall``. '''
+
+    for cnew, cdel in owners.items():
+        if '*' not in cnew:
+            yield cobjs[cnew], cobjs[cdel]
+            continue
+        pattern = re.compile('^' + re.escape(cnew).replace(r'\*', '(.*)', 1) + '$')
+        for name, cobj in dict(cobjs).items():
+            match = pattern.match(name)
+            if match is None or not isinstance(cobj, CFunction):
+                continue
+            if cobj.result.kind != 'pointer':
+                continue  # Only explicitly named pairs must return pointers
+            destructor = cobjs.get(cdel.replace('*', match.group(1), 1))
+            if isinstance(destructor, CFunction):
+                yield cobj, destructor
+
+
 def function_skeleton(cmodule=None, outargs=(), inoutargs=(), arrays=(), retargs=None,
            checkerr=None, noret=False, doc=None):
     """
@@ -485,7 +1963,8 @@ def function_skeleton(cmodule=None, outargs=(), inoutargs=(), arrays=(), retargs
 
 
 def cmethod(cfunc, outargs=(), inoutargs=(), arrays=(), retargs=None,
-           checkerr=None, noret=False, doc=None):
+           checkerr=None, noret=False, doc=None, allocator=None, align=None,
+           unaligned='copy', mutates=False):
     ''' Wrap cfunc to simplify handling outargs, etc.
 
     This feature helps to simplify dealing with pointer parameters which
@@ -534,6 +2013,19 @@ def cmethod(cfunc, outargs=(), inoutargs=(), arrays=(), retargs=None,
 
     * ``doc``: Optional string/object to attach to the returned function's docstring
 
+    * ``allocator``: Optional allocator (see ``allocator()``) for the pointers
+      and arrays created for ``outargs``, ``inoutargs`` and ``arrays``, e.g.
+      to skip zeroing arrays the C function fills in itself.
+
+    * ``align``: Optional byte alignment required for ``arrays``. New arrays are
+      allocated aligned. numpy arrays which aren't aligned are copied in to
+      aligned scratch space and the results copied back after the call, or
+      raise ``ValueError`` if ``unaligned`` is ``'raise'``.
+
+    * ``mutates``: Set to True if the C function changes the object passed as
+      the first argument, to clear any values cached by ``cproperty(...,
+      cache=True)`` on it after each call.
+
     As an example of using ``outargs`` and ``inoutargs``, a C function with
     this signature::
 
@@ -548,6 +2040,10 @@ def cmethod(cfunc, outargs=(), inoutargs=(), arrays=(), retargs=None,
     Returned values will be unboxed python values unless otherwise documented
     (i.e., arrays).
 
+    Without ``checkerr`` the ``_checkerr`` method of the first argument is
+    used, if it has one. ``CObject`` subclasses resolve this once, when the
+    class is created (see ``CObjectType``).
+
     '''
 
     # TODO: retargs...
@@ -569,39 +2065,75 @@ def cmethod(cfunc, outargs=(), inoutargs=(), arrays=(), retargs=None,
 
     outargs.sort()
 
-    @wraps(cfunc.cfunc)
-    def wrapper(*args):
-        if len(args) != numargs:
-            raise TypeError('wrapped Function {0} requires exactly {1} '
-                            'arguments ({2} given)'
-                            .format(cfunc.cname, numargs, len(args)))
+    def build(checkerr, bind):
+        # With bind, the error checker is bind(self) for each call, otherwise
+        # it's the given checkerr.
+        @wraps(cfunc.cfunc)
+        def wrapper(*args):
+            if len(args) != numargs:
+                raise TypeError('wrapped Function {0} requires exactly {1} '
+                                'arguments ({2} given)'
+                                .format(cfunc.cname, numargs, len(args)))
+
+            _checkerr = checkerr if bind is None else bind(args[0])
+            retvals = cfunc(*args, outargs=outargs, retargs=retargs, checkerr=_checkerr,
+                            allocator=allocator, align=align, unaligned=unaligned)
+
+            if noret:
+                if isinstance(retvals, tuple) and len(retvals) > 1:  # strip off the first return value
+                    retvals = retvals[1:]
+                    if len(retvals) == 1:
+                        retvals = retvals[0]
+                else:
+                    retvals = None
+            return retvals
+
+        if mutates:
+            wrapper = _mutating(wrapper)
+        if doc:
+            wrapper.__doc__ = doc
+        wrapper.cfunc = cfunc
+        return wrapper
+
+    if checkerr is not None:
+        return build(checkerr, None)
+    wrapper = build(None, _lookup_checkerr if numargs else None)
+    # Lets CObjectType replace the per call lookup of _checkerr
+    wrapper._cspecialize = build
+    wrapper._cbinding = None
+    return wrapper
 
-        if checkerr is None and hasattr(args[0], '_checkerr'):
-            _checkerr = args[0]._checkerr
-        else:
-            _checkerr = checkerr
-        retvals = cfunc(*args, outargs=outargs, retargs=retargs, checkerr=_checkerr)
-
-        if noret:
-            if isinstance(retvals, tuple) and len(retvals) > 1:  # strip off the first return value
-                retvals = retvals[1:]
-                if len(retvals) == 1:
-                    retvals = retvals[0]
-            else:
-                retvals = None
-        return retvals
 
-    if doc:
-        wrapper.__doc__ = doc
+def _lookup_checkerr(obj):
+    return getattr(obj, '_checkerr', None)
+
+
+def _mutating(func):
+    @wraps(func)
+    def wrapper(*args):
+        try:
+            return func(*args)
+        finally:
+            cinvalidate(args[0])
     return wrapper
 
 
+def _cfunc_ffi(func):
+    ''' The FFI object a ``cmethod``-wrapped function (or ``CFunction``) was
+    created with, falling back to the module global FFI. '''
+
+    cfunc = getattr(func, 'cfunc', None)
+    ffi = getattr(cfunc, 'ffi', None) or getattr(func, 'ffi', None)
+    return ffi if ffi is not None else _globalffi()
+
+
 def cstaticmethod(cfunc, **kwargs):
     ''' Shortcut for staticmethod(cmethod(cfunc, [kwargs ...])) '''
     return staticmethod(cmethod(cfunc, **kwargs))
 
 
-def cproperty(fget=None, fset=None, fdel=None, doc=None, checkerr=None):
+def cproperty(fget=None, fset=None, fdel=None, doc=None, checkerr=None,
+              cache=False, ttl=None):
     ''' Shortcut to create ``cmethod`` wrapped ``property``\ s.
 
     E.g., this:
@@ -618,14 +2150,154 @@ def cproperty(fget=None, fset=None, fdel=None, doc=None, checkerr=None):
     first form, or create and assign individual cmethods and put them in a
     normal property.
 
+    With ``cache`` set, the getter's result is kept per instance and returned
+    by later reads without calling C again, for getters which are expensive
+    and read more often than the value changes. ``ttl`` optionally limits how
+    many seconds a value is kept for. The cached value is dropped when the
+    property is set or deleted, when a ``cmethod(..., mutates=True)`` is
+    called on the instance, or by ``cinvalidate``.
+
     '''
 
+    if cache:
+        return _cachedproperty(cmethod(fget, checkerr=checkerr),
+                               cmethod(fset, checkerr=checkerr),
+                               cmethod(fdel, checkerr=checkerr),
+                               doc, ttl)
     return property(fget=cmethod(fget, checkerr=checkerr),
                     fset=cmethod(fset, checkerr=checkerr),
                     fdel=cmethod(fdel, checkerr=checkerr),
                     doc=doc)
 
 
+class _cachedproperty(property):
+    # The values are kept in a dict in the instance's __dict__, keyed by
+    # property, along with when they expire. Copies made by CObjectType for
+    # subclasses share the original's key.
+
+    def __init__(self, fget=None, fset=None, fdel=None, doc=None, ttl=None,
+                 key=None):
+        super(_cachedproperty, self).__init__(fget, fset, fdel, doc)
+        self.ttl = ttl
+        self._ckey = self if key is None else key
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        cache = obj.__dict__.get('_ccache')
+        if cache is None:
+            cache = obj.__dict__['_ccache'] = {}
+        entry = cache.get(self._ckey)
+        if entry is not None and (entry[1] is None or _clock() < entry[1]):
+            return entry[0]
+        value = super(_cachedproperty, self).__get__(obj, objtype)
+        cache[self._ckey] = (value, None if self.ttl is None else _clock() + self.ttl)
+        return value
+
+    def __set__(self, obj, value):
+        try:
+            super(_cachedproperty, self).__set__(obj, value)
+        finally:
+            cinvalidate(obj, self)
+
+    def __delete__(self, obj):
+        try:
+            super(_cachedproperty, self).__delete__(obj)
+        finally:
+            cinvalidate(obj, self)
+
+
+def cinvalidate(obj, *props):
+    ''' Drops the values cached by ``cproperty(..., cache=True)`` on ``obj``,
+    or only those of ``props``, given as property names or objects. '''
+    cache = getattr(obj, '__dict__', {}).get('_ccache')
+    if not cache:
+        return
+    if not props:
+        cache.clear()
+        return
+    for prop in props:
+        if isinstance(prop, _string_types):
+            prop = getattr(type(obj), prop)
+        cache.pop(getattr(prop, '_ckey', prop), None)
+
+
+# FFI objects structs can be unpickled with, by name. See register_ffi()
+_ffis = {}
+
+
+def register_ffi(ffi, name='default'):
+    ''' Registers ``ffi`` under ``name`` so pickled ``CStruct``, ``CStructArray``
+    and ``nparray`` objects of its types can be rebuilt. Unpickling processes
+    must register an FFI declaring the same types under the same name.
+    ``wrapall`` registers the first FFI it sees as ``'default'``. '''
+    _ffis[name] = ffi
+
+
+def _ffi_name(ffi):
+    if ffi is _global_ffi and ffi is not None:
+        return None  # Every process has its own module global FFI
+    for name, registered in _ffis.items():
+        if registered is ffi:
+            return name
+    raise pickle.PicklingError('FFI {0!r} is not registered, see '
+                               'cfficloak.register_ffi()'.format(ffi))
+
+
+def _pickle_data(buff, protocol):
+    ''' The contents of buff for a pickle, out-of-band where supported. '''
+    if protocol >= 5 and hasattr(pickle, 'PickleBuffer'):
+        return pickle.PickleBuffer(buff)
+    return bytes(buff)
+
+
+def _registered_ffi(name):
+    return _globalffi() if name is None else _ffis[name]
+
+
+def _unpickle_cdata(ffi, ctype, data):
+    cdata = ffi.new(ctype)
+    data = memoryview(data).cast('B')
+    ffi.memmove(cdata, data, data.nbytes)
+    return cdata
+
+
+def _unpickle_struct(ffi_name, cname, data):
+    ffi = _registered_ffi(ffi_name)
+    return wrap(ffi, _unpickle_cdata(ffi, ffi.getctype(cname, '*'), data))
+
+
+def _unpickle_struct_array(ffi_name, ctype, data):
+    ffi = _registered_ffi(ffi_name)
+    return CStructArray(ffi, _unpickle_cdata(ffi, ctype, data))
+
+
+def _unpickle_nparray(dtype, data):
+    nbytes = memoryview(data).nbytes
+    cdata = _unpickle_cdata(_globalffi(), 'uint8_t[%i]' % nbytes, data)
+    return nparray(cdata, dtype=dtype)
+
+
+# Field types and default python converters per struct ctype, so wrapping a
+# struct doesn't need to walk its fields every time.
+_struct_layouts = {}
+
+
+def _struct_layout(ffi, struct_type):
+    fldnames = {} if struct_type.fields is None else {detail[0]: detail[1].type for detail in struct_type.fields}
+
+    # default formatters
+    # these can be overridden or removed later with set_py_converter()
+    pfields = {}
+    for key, fieldtype in fldnames.items():
+        cname = fieldtype.cname
+        if cname.startswith('char') and ('[' in cname or '*' in cname):
+            pfields[key] = ffi.string  # add string output formatter
+
+    _struct_layouts[struct_type] = (fldnames, pfields)
+    return _struct_layouts[struct_type]
+
+
 class CStruct(object):
     ''' Provides introspection to an instantiation of a CFFI ``StructType``s and ``UnionType``s.
 
@@ -671,14 +2343,12 @@ class CStruct(object):
         except AttributeError:
             self._cname = self.__struct_type.get_c_name()
 
-        self.__fldnames = {} if self.__struct_type.fields is None else {detail[0]: detail[1].type for detail in self.__struct_type.fields}
-
-        # default formatters
-        # these can be overridden or removed later with set_py_converter()
-        for key, fieldtype in six.iteritems(self.__fldnames):
-            cname = fieldtype.cname
-            if cname.startswith('char') and ('[' in cname or '*' in cname):
-                self.__pfields[key] = self._ffi.string  # add string output formatter
+        layout = _struct_layouts.get(self.__struct_type)
+        if layout is None:
+            layout = _struct_layout(ffi, self.__struct_type)
+        self.__fldnames = layout[0]  # Shared between instances, don't modify
+        self.__pfields = dict(layout[1])
+        self.__layout = layout
 
     def __dir__(self):
         """
@@ -708,7 +2378,7 @@ class CStruct(object):
             value = self._hton(key, value)
             cname = self.__fldnames[key].cname
             if 'char' in cname and ('[' in cname or '*' in cname):
-                if isinstance(value, (numpy.ndarray, nparray)):
+                if isinstance(value, nparray) or _isndarray(value):
                     self.__pfields[key] = value
                     value = nparrayptr(value)
                 elif isinstance(value, (bytes, str)):
@@ -720,6 +2390,14 @@ class CStruct(object):
         else:
             return super(CStruct, self).__setattr__(key, value)
 
+    def _rebind(self, cdata):
+        # Points this wrapper at another struct of the same type, for cursors
+        # walking over an array. Wrappers cached for nested fields belong to
+        # the old struct so are dropped.
+        object.__setattr__(self, '_cdata', cdata)
+        if len(self.__pfields) != len(self.__layout[1]):
+            self.__pfields = dict(self.__layout[1])
+
     def set_py_converter(self, key, fn=None):  # TODO have converters for set as well as get?
         if fn is None and key in self.__pfields:
             del self.__pfields['key']
@@ -760,6 +2438,16 @@ class CStruct(object):
         recurse = [f.get_named_tuple() if isinstance(f, CStruct) else f for f in vals]
         return namedtuple(self._cname, self.__fldnames)(*recurse)
 
+    def __reduce_ex__(self, protocol):
+        # Pickled as the struct's raw bytes, rebuilt with a single memmove in
+        # to a new struct from the registered FFI of the same name.
+        cdata = self._cdata
+        if self._ffi.typeof(cdata).kind != 'pointer':
+            cdata = self._ffi.addressof(cdata)
+        return (_unpickle_struct,
+                (_ffi_name(self._ffi), self._cname,
+                 _pickle_data(self._ffi.buffer(cdata), protocol)))
+
 
 class CStructType(object):
     ''' Provides introspection to CFFI ``StructType``s and ``UnionType``s.
@@ -797,6 +2485,7 @@ class CStructType(object):
 
         self.fldnames = None
         self._cdata = None
+        self.pool = None
 
         if isinstance(structtype, str):
             try:
@@ -839,18 +2528,64 @@ class CStructType(object):
                 raise TypeError('CStructType got more arguments than struct '
                                 'has fields. {0} > {1}'
                                 .format(len(args), len(self.fldnames)))
-            retval = self.ffi.new(self.ptrname)
-            for fld, val in zip(self.fldnames, args):
-                if fld in kwargs:
-                    raise TypeError('CStructType call got multiple values for '
-                                    'field name {0}'.format(fld))
-                setattr(retval, fld, val)
-            for fld, val in kwargs.items():
-                setattr(retval, fld, val)
-
+            if self.pool is not None:
+                retval = self._pool_new()
+            else:
+                retval = self.ffi.new(self.ptrname)
+                if _alloc_sites is not None:
+                    _track(self.ffi, retval, 'struct', self.cname)
+            self._setfields(retval, args, kwargs)
             return wrap(self.ffi, retval)
 
-    def array(self, shape):
+    def _setfields(self, cdata, args, kwargs):
+        for fld, val in zip(self.fldnames, args):
+            if fld in kwargs:
+                raise TypeError('CStructType call got multiple values for '
+                                'field name {0}'.format(fld))
+            setattr(cdata, fld, val)
+        for fld, val in kwargs.items():
+            setattr(cdata, fld, val)
+
+    def set_pool(self, size):
+        ''' Enables pooling of the structs created by calling this type.
+
+        Up to ``size`` structs are kept on a free list when released, instead
+        of being freed, and are zeroed and reused by later calls. Structs are
+        released when their last reference goes away. Pool counters are
+        available from ``self.pool.stats()`` or ``pool_stats()``.
+
+        A ``size`` of 0 disables pooling again.
+
+        '''
+
+        key = getattr(self, '_pool_key', None)
+        if not size:
+            if key is not None and _pools.get(key) is self.pool:
+                del _pools[key]
+            self.pool = None
+            return
+        if self.fldnames is None:
+            raise TypeError("Can't pool opaque CFFI struct {0}".format(self.cname))
+        if key is None:
+            # Each type object has its own pool, even for the same struct
+            key = self._pool_key = 'struct:{0}#{1}'.format(self.cname, next(_struct_pool_ids))
+        self._zeros = b'\0' * self.ffi.sizeof(self.cname)
+        self.pool = _pools[key] = FreeList(size)
+
+    def _pool_new(self):
+        pool = self.pool
+        ptr = pool.get()
+        if ptr is None:
+            ptr = self.ffi.new(self.ptrname)
+            if _alloc_sites is not None:
+                _track(self.ffi, ptr, 'struct', self.cname)
+        else:
+            self.ffi.memmove(ptr, self._zeros, len(self._zeros))
+        # The gc destructor gets the original owning pointer back, which is
+        # what goes on the free list.
+        return self.ffi.gc(ptr, pool.put)
+
+    def array(self, shape, allocator=None, align=None, shared=False):
         ''' Constructs a C array of the struct type with the given length.
 
         * ``shape``: Either an int for the length of a 1-D array, or a tuple
@@ -859,20 +2594,570 @@ class CStructType(object):
           pointers just add an extra demension with length 1. I.e., [2,2,1] is
           a 2x2 array of pointers to structs.
 
+        * ``allocator``: Optional allocator (see ``allocator()``), otherwise
+          the module default allocator or ``ffi.new`` is used.
+        * ``align``: Optional byte alignment for the start of the array, e.g.
+          64 for AVX-512 kernels.
+        * ``shared``: If True, allocate the array in
+          ``multiprocessing.shared_memory`` and return a ``SharedArray`` handle
+          which other processes can attach to.
+
         No explicit initialization of the elements is performed, however CFFI
-        itself automatically initializes newly allocated memory to zeros.
+        itself automatically initializes newly allocated memory to zeros unless
+        an allocator with ``should_clear_after_alloc=False`` is used.
 
         '''
 
         # TODO: Factor out and integrate with carray function below?
-        if isinstance(shape, collections.Iterable):
+        if isinstance(shape, collections_abc.Iterable):
             suffix = ('[%i]' * len(shape)) % tuple(shape)
         else:
             suffix = '[%i]' % (shape,)
 
         # TODO Allow passing initialization args? Maybe factor out some of the
         # code in CStructType.__call__?
-        return self.ffi.new(self.ffi.getctype(self.cname + suffix))
+        ctype = self.ffi.getctype(self.cname + suffix)
+        if shared:
+            return SharedArray(self.ffi, ctype)
+        if align:
+            return _aligned_new(self.ffi, ctype, align, allocator, 'struct_array', self.cname)
+        if allocator is None:
+            allocator = _default_allocator
+        if allocator is None:
+            cdata = self.ffi.new(ctype)
+        else:
+            cdata = allocator(self.ffi.typeof(ctype))
+        if _alloc_sites is not None:
+            _track(self.ffi, cdata, 'struct_array', self.cname)
+        return cdata
+
+    def from_file(self, path, offset=0, count=None, writable=False):
+        ''' Memory-maps a file of packed records of this struct type and
+        returns them as a ``CStructArray``, without reading or copying them.
+        Pages are read in from the file as the records are accessed.
+
+        * ``path``: The file to map.
+        * ``offset``: Byte offset of the first record in the file.
+        * ``count``: Number of records, by default as many whole records as
+          fit in the rest of the file.
+        * ``writable``: If True, changes to the records are written back to
+          the file (call ``flush()`` on the array to force it). Otherwise
+          changes only affect this process's copy.
+
+        '''
+
+        size = self.ffi.sizeof(self.cname)
+        with open(path, 'r+b' if writable else 'rb') as f:
+            if count is None:
+                count = (os.fstat(f.fileno()).st_size - offset) // size
+            if count <= 0:
+                raise ValueError('No {0} records in {1} at offset {2}'
+                                 .format(self.cname, path, offset))
+            # mmap offsets must be a multiple of the allocation granularity
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            mapping = mmap.mmap(f.fileno(), offset - start + count * size,
+                                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_COPY,
+                                offset=start)
+        view = memoryview(mapping)[offset - start:offset - start + count * size]
+        cdata = self.ffi.from_buffer(self.ffi.getctype(self.cname, '[%i]' % count), view)
+        return CStructArray(self.ffi, cdata, owner=mapping)
+
+    def stream(self, fileobj, batch=1024):
+        ''' Reads packed records of this struct type from a blocking file,
+        pipe or socket, yielding them in ``CStructArray`` batches.
+
+        All reads go with ``readinto`` (or ``recv_into`` for sockets) in to
+        one reusable buffer of ``batch`` records, so memory use is constant
+        and nothing is allocated per record. Each yielded batch is a view of
+        that buffer and is only valid until the next batch is requested; copy
+        out anything that needs to be kept. Records split across reads are
+        carried over to the next batch.
+
+        ``EOFError`` is raised if the stream ends part way through a record.
+
+        '''
+
+        ffi = self.ffi
+        size = ffi.sizeof(self.cname)
+        cdata = ffi.new(ffi.getctype(self.cname, '[%i]' % batch))
+        if _alloc_sites is not None:
+            _track(ffi, cdata, 'stream', self.cname)
+        buff = memoryview(ffi.buffer(cdata))
+        readinto = getattr(fileobj, 'readinto', None) or fileobj.recv_into
+        filled = 0
+        while True:
+            nread = readinto(buff[filled:])
+            if not nread:
+                if filled:
+                    raise EOFError('{0} bytes of a partial {1} record left at '
+                                   'end of stream'.format(filled, self.cname))
+                return
+            filled += nread
+            count = filled // size
+            if not count:
+                continue
+            yield CStructArray(ffi, cdata[0:count], owner=cdata)
+            used = count * size
+            filled -= used
+            if filled:
+                ffi.memmove(cdata, ffi.cast('char *', cdata) + used, filled)
+
+
+class CStructArray(object):
+    ''' A sequence over a C array of structs or unions, with items returned
+    as ``CStruct`` wrappers so the usual field semantics apply.
+
+    * ``ffi``: The FFI object.
+    * ``cdata``: A CFFI array of structs.
+    * ``owner``: Optional object owning the memory, kept alive with the array.
+
+    The array can be passed directly to wrapped C functions. Slices (with a
+    step of 1) are views over the same memory.
+
+    '''
+
+    def __init__(self, ffi, cdata, owner=None):
+        self._ffi = ffi
+        self._cdata = cdata
+        self._owner = owner
+
+    def __len__(self):
+        return len(self._cdata)
+
+    def _index(self, index):
+        length = len(self._cdata)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('index {0} out of range'.format(index))
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._cdata))
+            if step != 1:
+                raise ValueError('CStructArray slices must have a step of 1')
+            return CStructArray(self._ffi, self._cdata[start:max(start, stop)], owner=self)
+        item = wrap(self._ffi, self._cdata + self._index(index))
+        item._owner = self  # Items are references in to our memory
+        return item
+
+    def __setitem__(self, index, value):
+        if hasattr(value, '_cdata'):
+            value = value._cdata
+            if self._ffi.typeof(value).kind == 'pointer':
+                value = value[0]
+        self._cdata[self._index(index)] = value
+
+    def __iter__(self):
+        for index in range(len(self._cdata)):
+            yield self[index]
+
+    def __repr__(self):
+        return '<CStructArray {0}>'.format(self._ffi.typeof(self._cdata).cname)
+
+    def __reduce_ex__(self, protocol):
+        return (_unpickle_struct_array,
+                (_ffi_name(self._ffi), self._ffi.typeof(self._cdata).cname,
+                 _pickle_data(self._ffi.buffer(self._cdata), protocol)))
+
+    def flush(self):
+        ''' Flushes changes to a file-backed array (see ``CStructType.from_file``). '''
+        owner = self._owner
+        while isinstance(owner, CStructArray):
+            owner = owner._owner
+        if hasattr(owner, 'flush'):
+            owner.flush()
+
+
+class StructWriter(object):
+    ''' Writes structs, struct arrays and numpy arrays to a file descriptor,
+    file or socket straight from their memory with ``os.writev`` or
+    ``socket.sendmsg``, without first copying them in to ``bytes``.
+
+    * ``target``: A file descriptor, an object with a ``fileno()`` method, or
+      a socket.
+    * ``batch_bytes``: Writes are queued until this many bytes are pending.
+    * ``coalesce``: Records smaller than this many bytes are copied in to a
+      shared staging buffer instead of getting their own iovec, which keeps
+      the syscall count down when writing many small records.
+
+    Larger records are queued by reference, so they must not be modified
+    until they've been flushed. Use as a context manager or call ``close()``
+    to flush what's left. ``syscalls`` counts the write calls made.
+
+    '''
+
+    def __init__(self, target, batch_bytes=65536, coalesce=256):
+        self.target = target
+        self.batch_bytes = batch_bytes
+        self.coalesce = coalesce
+        self.syscalls = 0
+        self._iov = []
+        self._stage = bytearray()
+        self._pending = 0
+        try:
+            self._iov_max = os.sysconf('SC_IOV_MAX')
+        except (AttributeError, ValueError, OSError):
+            self._iov_max = 1024
+
+    @staticmethod
+    def _view(obj):
+        ''' A flat byte memoryview of the memory behind obj. '''
+        if isinstance(obj, nparray):
+            obj = obj.ndarray
+        elif hasattr(obj, '_cdata'):
+            obj = obj._cdata
+        ffi = _globalffi()
+        if isinstance(obj, ffi.CData):
+            if ffi.typeof(obj).kind in ('struct', 'union'):
+                obj = ffi.addressof(obj)
+            obj = ffi.buffer(obj)
+        return memoryview(obj).cast('B')
+
+    def write(self, obj):
+        ''' Queues one struct, array or buffer, flushing if enough is pending. '''
+        view = self._view(obj)
+        if view.nbytes < self.coalesce:
+            self._stage += view
+        else:
+            if self._stage:
+                self._iov.append(self._stage)
+                self._stage = bytearray()
+            self._iov.append(view)
+        self._pending += view.nbytes
+        if self._pending >= self.batch_bytes or len(self._iov) >= self._iov_max - 1:
+            self.flush()
+
+    def writemany(self, objs):
+        for obj in objs:
+            self.write(obj)
+
+    def flush(self):
+        ''' Writes everything queued. '''
+        iov = self._iov
+        if self._stage:
+            iov.append(self._stage)
+        self._iov, self._stage, self._pending = [], bytearray(), 0
+        iov = [memoryview(buff) for buff in iov]
+        while iov:
+            written = self._writev(iov[:self._iov_max])
+            self.syscalls += 1
+            # Drop everything written, and the written part of a partial write
+            while iov and written >= iov[0].nbytes:
+                written -= iov.pop(0).nbytes
+            if written:
+                iov[0] = iov[0][written:]
+
+    def _writev(self, iov):
+        target = self.target
+        if hasattr(target, 'sendmsg'):
+            return target.sendmsg(iov)
+        if not isinstance(target, _integer_types):
+            if hasattr(target, 'flush'):
+                target.flush()
+            target = target.fileno()
+        if hasattr(os, 'writev'):
+            return os.writev(target, iov)
+        return os.write(target, b''.join(iov))
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _SharedBlock(object):
+    # Stands for a SharedArray's mapping, see SharedArray.__init__
+
+    def keepalive(self, cdata):
+        pass
+
+
+class SharedArray(object):
+    ''' A C array in ``multiprocessing.shared_memory``, as returned by
+    ``CStructType.array(..., shared=True)`` and ``carray(..., shared=True)``.
+
+    * ``ffi``: The FFI object.
+    * ``ctype``: The fixed size C array type, e.g. ``'point_t[100]'``.
+    * ``name``: The shared memory block to attach to. If not given a new,
+      zeroed, block is created and this handle owns it.
+
+    ``array`` is a zero-copy view of the shared memory: a ``CStructArray`` for
+    1-D arrays of structs or unions, the CFFI array otherwise. Indexing and
+    ``len()`` on the handle go to ``array``.
+
+    Other processes attach with ``SharedArray.attach(name, ctype)``, or by
+    being sent the handle, which pickles as just its name and type. The
+    owning handle unlinks the block when it's closed, or once neither it nor
+    ``array`` is reachable, in the process which created it. Attached handles
+    only unmap it. ``array`` and the structs taken from it keep the handle
+    alive, but pointers taken from them don't, and nothing taken from
+    ``array`` may be used after the handle is closed.
+
+    '''
+
+    def __init__(self, ffi, ctype, name=None):
+        from multiprocessing import shared_memory
+
+        self.ffi = ffi
+        self.ctype = ctype
+        nbytes = ffi.sizeof(ctype)
+        if name is None:
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            try:
+                shm = shared_memory.SharedMemory(name, track=False)
+            except TypeError:
+                shm = shared_memory.SharedMemory(name)
+                # Before Python 3.13 attaching also registers the block with
+                # the resource tracker, which would unlink it when this
+                # process exits even though we don't own it.
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        self.name = shm.name
+        self.owner = name is None
+
+        # The block may be larger than requested once rounded to pages
+        view = shm.buf[:nbytes]
+        cdata = ffi.from_buffer(ctype, view, require_writable=True)
+        # The mapping is closed when the block is collected, which the array
+        # keeps alive. Neither refers back to this handle, so dropping the
+        # handle and the array frees it without waiting for the cyclic gc.
+        block = _SharedBlock()
+        # Only the creating process unlinks, not children it forks
+        self._finalizer = weakref.finalize(block, SharedArray._close, ffi, cdata, view,
+                                           shm, os.getpid() if self.owner else None)
+        arrtype = ffi.typeof(cdata)
+        if arrtype.item.kind in ('struct', 'union'):
+            self.array = CStructArray(ffi, cdata, owner=block)
+        else:
+            # The destructor does nothing, it's only there so the array
+            # holds a reference to the block.
+            self.array = ffi.gc(cdata, block.keepalive)
+
+    @classmethod
+    def attach(cls, name, ctype, ffi=None):
+        ''' Attaches to the shared array called ``name`` created by another
+        handle, with the same ``ctype``. ``ffi`` defaults to the registered
+        ``'default'`` FFI (see ``register_ffi``). '''
+        return cls(ffi if ffi is not None else _ffis.get('default') or _globalffi(), ctype, name)
+
+    @staticmethod
+    def _close(ffi, cdata, view, shm, owner_pid):
+        release = getattr(ffi, 'release', None)
+        if release is not None:
+            release(cdata)
+        view.release()
+        shm.close()
+        if owner_pid == os.getpid():
+            shm.unlink()
+
+    def close(self):
+        ''' Unmaps the shared memory, and unlinks it if this is the owner. '''
+        self.array = None
+        self._finalizer()
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __setitem__(self, index, value):
+        self.array[index] = value
+
+    def __reduce__(self):
+        return (_attach_shared, (_ffi_name(self.ffi), self.ctype, self.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _attach_shared(ffi_name, ctype, name):
+    return SharedArray(_registered_ffi(ffi_name), ctype, name)
+
+
+class StructRing(object):
+    ''' A single producer, single consumer ring buffer of C structs in
+    ``multiprocessing.shared_memory``.
+
+    * ``structtype``: The ``CStructType`` of the records.
+    * ``capacity``: The number of slots, a power of two. Ignored when
+      attaching.
+    * ``name``: The shared memory block of an existing ring to attach to. If
+      not given a new ring is created and this handle owns it, as for
+      ``SharedArray``.
+
+    The block starts with a header holding the head (write) and tail (read)
+    counters on separate cache lines, followed by the slots. Only the producer
+    stores the head and only the consumer stores the tail, so no locks are
+    needed. Each side keeps its own copy of the other's counter and only
+    reloads it from shared memory when the ring looks full or empty.
+
+    The producer calls ``push()``, or ``reserve()`` to fill a slot in place
+    and ``commit()`` to publish it. The consumer calls ``pop()`` for one
+    record or ``drain()`` for all records that are ready. Records are handed
+    out as cursor views of the slots, not copies: a view is valid until the
+    next ``pop()``, ``drain()`` or ``release()`` call on the same handle,
+    after which the producer may reuse the slot.
+
+    The other side attaches with ``StructRing.attach(name, structtype)`` or
+    by being sent the handle, which pickles as just its name and type.
+
+    Counters are plain aligned 64 bit loads and stores. The slot is written
+    before the head is stored and read before the tail is stored, which
+    relies on the platform keeping stores in order (as x86-64 does). A C
+    producer or consumer sharing the ring should use release stores and
+    acquire loads on the counters.
+
+    '''
+
+    _magic = 0x676e6972746373  # 'sctring'
+    _header = 256
+    _HEAD = 0    # uint64_t offsets in to the header
+    _TAIL = 8
+    _CAPACITY = 16
+    _SLOTSIZE = 17
+    _MAGIC = 18
+
+    def __init__(self, structtype, capacity=1024, name=None):
+        if structtype.fldnames is None:
+            raise TypeError("Can't make a ring of opaque CFFI struct {0}".format(structtype.cname))
+        self.structtype = structtype
+        ffi = structtype.ffi
+        size = ffi.sizeof(structtype.cname)
+        gffi = _globalffi()
+        if name is None:
+            if capacity < 1 or capacity & (capacity - 1):
+                raise ValueError('StructRing capacity must be a power of two, got {0}'.format(capacity))
+            self.shared = SharedArray(gffi, 'uint8_t[%d]' % (self._header + capacity * size))
+            header = gffi.cast('uint64_t *', self.shared.array)
+            header[self._CAPACITY] = capacity
+            header[self._SLOTSIZE] = size
+            header[self._MAGIC] = self._magic
+        else:
+            # Read the capacity from the header before mapping the slots
+            probe = SharedArray(gffi, 'uint8_t[%d]' % self._header, name)
+            header = gffi.cast('uint64_t *', probe.array)
+            if header[self._MAGIC] != self._magic:
+                probe.close()
+                raise ValueError('Shared memory {0} is not a StructRing'.format(name))
+            if header[self._SLOTSIZE] != size:
+                slotsize = header[self._SLOTSIZE]
+                probe.close()
+                raise ValueError('StructRing {0} has {1} byte slots, {2} is {3} bytes'
+                                 .format(name, slotsize, structtype.cname, size))
+            capacity = int(header[self._CAPACITY])
+            probe.close()
+            self.shared = SharedArray(gffi, 'uint8_t[%d]' % (self._header + capacity * size), name)
+            header = gffi.cast('uint64_t *', self.shared.array)
+
+        self.name = self.shared.name
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._hdr = header
+        self._slots = ffi.cast(structtype.ptrname, self.shared.array + self._header)
+        self._zeros = b'\0' * size
+        self._head = self._headcache = int(header[self._HEAD])
+        self._tail = self._tailcache = int(header[self._TAIL])
+        self._consumed = 0
+        self._wcursor = CStruct(ffi, self._slots)
+        self._rcursor = CStruct(ffi, self._slots)
+
+    @classmethod
+    def attach(cls, name, structtype):
+        ''' Attaches to the ring called ``name`` created by another handle. '''
+        return cls(structtype, name=name)
+
+    def reserve(self):
+        ''' Returns a cursor on the next free slot, zeroed, or None if the
+        ring is full. The record is published by ``commit()``. '''
+        head = self._head
+        if head - self._tailcache >= self.capacity:
+            self._tailcache = self._hdr[self._TAIL]
+            if head - self._tailcache >= self.capacity:
+                return None
+        slot = self._slots + (head & self._mask)
+        self.structtype.ffi.memmove(slot, self._zeros, len(self._zeros))
+        self._wcursor._rebind(slot)
+        return self._wcursor
+
+    def commit(self):
+        ''' Publishes the slot returned by ``reserve()`` to the consumer. '''
+        self._head += 1
+        self._hdr[self._HEAD] = self._head
+
+    def push(self, *args, **kwargs):
+        ''' Writes a record from positional and/or keyword field values, as
+        for ``CStructType``. Returns False if the ring is full. '''
+        slot = self.reserve()
+        if slot is None:
+            return False
+        self.structtype._setfields(slot._cdata, args, kwargs)
+        self.commit()
+        return True
+
+    def release(self):
+        ''' Hands the slots given out by the last ``pop()`` or ``drain()``
+        back to the producer. Called automatically by the next of either. '''
+        if self._consumed:
+            self._tail += self._consumed
+            self._consumed = 0
+            self._hdr[self._TAIL] = self._tail
+
+    def pop(self):
+        ''' Returns a cursor on the oldest record, or None if the ring is empty. '''
+        self.release()
+        tail = self._tail
+        if tail >= self._headcache:
+            self._headcache = self._hdr[self._HEAD]
+            if tail >= self._headcache:
+                return None
+        self._consumed = 1
+        self._rcursor._rebind(self._slots + (tail & self._mask))
+        return self._rcursor
+
+    def drain(self, limit=None):
+        ''' Returns a ``CStructArray`` view of the records that are ready, at
+        most ``limit`` of them. The view stops at the end of the slots when
+        the records wrap around, so call again until it comes back empty. '''
+        self.release()
+        self._headcache = self._hdr[self._HEAD]
+        start = self._tail & self._mask
+        count = min(self._headcache - self._tail, self.capacity - start)
+        if limit is not None:
+            count = min(count, limit)
+        self._consumed = count
+        return CStructArray(self.structtype.ffi, self._slots[start:start + count], owner=self)
+
+    def __len__(self):
+        return int(self._hdr[self._HEAD] - self._hdr[self._TAIL])
+
+    def close(self):
+        ''' Unmaps the ring, and unlinks it if this is the owner. '''
+        self._hdr = self._slots = None
+        self.shared.close()
+
+    def __reduce__(self):
+        return (_attach_ring, (_ffi_name(self.structtype.ffi), self.structtype.cname, self.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _attach_ring(ffi_name, cname, name):
+    return StructRing(CStructType(_registered_ffi(ffi_name), cname), name=name)
 
 
 class CUnion(CStruct):
@@ -920,7 +3205,7 @@ class CType(object):
         return wrapped
 
 
-class Enum(long if six.PY2 else int):
+class Enum(long if _PY2 else int):
     """
     This is a base class for wrapping enum ints
     wrapenum() below will subtype it for a particular enum
@@ -928,6 +3213,7 @@ class Enum(long if six.PY2 else int):
     but display/print as the string representation from the enum
     """
     _names = {}
+    _values = {}  # Preconstructed singleton instance for each declared value
 
     def __new__(cls, *args, **kwargs):
         return super(Enum, cls).__new__(cls, *args, **kwargs)
@@ -939,6 +3225,21 @@ class Enum(long if six.PY2 else int):
 _enumTypes = {}
 
 
+def _enumtype(enumTypeDescr):
+    """
+    Returns the cached Enum subclass for an enum ctype, creating it (and the
+    interned instances for every declared value) on first use.
+    """
+    if isinstance(enumTypeDescr, CType):
+        enumTypeDescr = enumTypeDescr.ffi.typeof(enumTypeDescr.typedef)
+    enum = _enumTypes.get(enumTypeDescr.cname)
+    if enum is None:
+        enum = type(enumTypeDescr.cname, (Enum, ), {"_names": enumTypeDescr.elements})
+        enum._values = {val: enum(val) for val in enumTypeDescr.elements}
+        _enumTypes[enumTypeDescr.cname] = enum
+    return enum
+
+
 def wrapenum(retval, enumTypeDescr):
     """
     Wraps enum int in an auto-generated wrapper class. This is used automatically when
@@ -947,15 +3248,187 @@ def wrapenum(retval, enumTypeDescr):
     :param enumTypeDescr or CType: the cTypeDescr for the enum
     :return: subclass of Enum
     """
-    def _newEnumType(enumTypeDescr):
-        _enumTypes[enumTypeDescr.cname] = type(enumTypeDescr.cname, (Enum, ), {"_names": enumTypeDescr.elements})
-        return _enumTypes[enumTypeDescr.cname]
-    if isinstance(enumTypeDescr, CType):
-        enumTypeDescr = enumTypeDescr.ffi.typeof(enumTypeDescr.typedef)
-    enum = _enumTypes.get(enumTypeDescr.cname, _newEnumType(enumTypeDescr))
-    return enum(retval)
+    try:
+        enum = _enumTypes[enumTypeDescr.cname]
+    except (KeyError, AttributeError):
+        enum = _enumtype(enumTypeDescr)
+    try:
+        return enum._values[retval]
+    except KeyError:
+        return enum(retval)
+
+
+def wrapenum_array(codes, enumTypeDescr):
+    """
+    Vectorised version of wrapenum() for numpy arrays of enum codes
+    :param codes: numpy array (or sequence) of integer enum values
+    :param enumTypeDescr or CType: the cTypeDescr for the enum
+    :return: numpy object array, same shape as codes, of the enum names.
+             Undeclared values are rendered as their integer string like Enum.__str__
+    """
+    numpy = _numpy()
+    if not numpy:
+        raise NotImplementedError("numpy module required")
+    enum = _enumtype(enumTypeDescr)
+    codes = numpy.asarray(codes)
+    if not enum._names:
+        return codes.astype(str).astype(object)
+    keys = numpy.array(sorted(enum._names), dtype=numpy.int64)
+    names = numpy.array([enum._names[k] for k in keys] + [None], dtype=object)
+    idx = numpy.searchsorted(keys, codes).clip(0, len(keys) - 1)
+    found = keys[idx] == codes
+    result = names[numpy.where(found, idx, len(keys))]
+    if not numpy.all(found):
+        result = numpy.where(found, result, codes.astype(str).astype(object))
+    return result
+
+
+def _add_metaclass(metaclass):
+    # Class decorator for creating a class with a metaclass, in a way that
+    # works for both python 2 and 3.
+    def wrapper(cls):
+        namespace = dict(cls.__dict__)
+        namespace.pop('__dict__', None)
+        namespace.pop('__weakref__', None)
+        return metaclass(cls.__name__, cls.__bases__, namespace)
+    return wrapper
+
+
+def _class_attr(cls, name):
+    # The raw attribute from the class dicts, without descriptors applied
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass.__dict__[name]
+    return None
+
+
+class _cfield(object):
+    # Reads a field of an object's _cdata. Only defines __get__, so values
+    # assigned to an instance still shadow it as they did with __getattr__.
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        cdata = obj._cdata
+        if cdata is None:
+            raise AttributeError("{0} object has no attribute {1}"
+                                 .format(repr(type(obj)), repr(self.name)))
+        return getattr(cdata, self.name)
+
+
+class CObjectType(type):
+    ''' Metaclass of ``CObject``, which specializes each class when it is
+    created so that work isn't repeated on every call.
 
+    * ``cmethod`` and ``cproperty`` attributes, including inherited ones, are
+      bound to the class's ``_checkerr`` rather than looking it up on the
+      instance per call. ``_checkerr`` therefore has to be defined on the
+      class, assigning it to an instance has no effect on them.
 
+    * If the class declares the C type of its ``_cdata`` with ``_ctype``, a
+      ``ffi.typeof`` result or a type name like ``'point_t *'``, the struct's
+      fields are forwarded with descriptors rather than by ``__getattr__``.
+      Fields with the same name as an attribute of the class are skipped. Type
+      names are looked up in the FFI of the class's C functions, or the
+      ``'default'`` FFI (see ``register_ffi``).
+
+    '''
+
+    def __init__(cls, name, bases, namespace):
+        super(CObjectType, cls).__init__(name, bases, namespace)
+        cls._cspecialize()
+        if cls.__dict__.get('_ctype') is not None:
+            cls._cforward(cls.__dict__['_ctype'])
+
+    def _cspecialize(cls):
+        raw = _class_attr(cls, '_checkerr')
+        if raw is None:
+            checkerr, bind = None, None
+        elif isinstance(raw, (staticmethod, classmethod)) or not hasattr(raw, '__get__'):
+            checkerr, bind = getattr(cls, '_checkerr'), None
+        else:
+            checkerr, bind = None, raw.__get__
+        binding = (checkerr, raw)
+
+        def specialize(func):
+            if getattr(func, '_cbinding', binding) == binding:
+                return func
+            build = func._cspecialize
+            func = build(checkerr, bind)
+            func._cspecialize = build
+            func._cbinding = binding
+            return func
+
+        seen = set()
+        for klass in cls.__mro__:
+            for attr, value in list(klass.__dict__.items()):
+                if attr in seen:
+                    continue
+                seen.add(attr)
+                if type(value) in (property, _cachedproperty):
+                    funcs = (value.fget, value.fset, value.fdel)
+                    new = tuple(specialize(func) for func in funcs)
+                    if new == funcs:
+                        continue
+                    if type(value) is _cachedproperty:
+                        value = _cachedproperty(*new, doc=value.__doc__,
+                                                ttl=value.ttl, key=value._ckey)
+                    else:
+                        value = property(*new, doc=value.__doc__)
+                elif hasattr(value, '_cspecialize') and not isinstance(value, type):
+                    new = specialize(value)
+                    if new is value:
+                        continue
+                    value = new
+                else:
+                    continue
+                setattr(cls, attr, value)
+
+    def _cffi(cls):
+        # The FFI of the class's C functions, or the registered default one
+        seen = set()
+        for klass in cls.__mro__:
+            for attr, value in klass.__dict__.items():
+                if attr in seen:
+                    continue
+                seen.add(attr)
+                if isinstance(value, staticmethod):
+                    value = value.__func__
+                elif isinstance(value, property):
+                    value = value.fget
+                ffi = getattr(getattr(value, 'cfunc', None), 'ffi', None)
+                if ffi is not None:
+                    return ffi
+        return _ffis.get('default')
+
+    def _cforward(cls, ctype):
+        if isinstance(ctype, _string_types):
+            ffi = cls._cffi()
+            resolved = None
+            if ffi is not None:
+                try:
+                    resolved = ffi.typeof(ctype)
+                except (cffi.CDefError, cffi.FFIError):
+                    pass
+            if resolved is None:
+                raise TypeError("Can't resolve _ctype {0!r} of {1} without an FFI "
+                                "declaring it, set _ctype to ffi.typeof({0!r})"
+                                .format(ctype, cls.__name__))
+            ctype = resolved
+        if ctype.kind == 'pointer':
+            ctype = ctype.item
+        if ctype.kind not in ('struct', 'union') or ctype.fields is None:
+            raise TypeError('_ctype of {0} is not a struct or union type: {1}'
+                            .format(cls.__name__, ctype.cname))
+        for field, _ in ctype.fields:
+            if not hasattr(cls, field):
+                setattr(cls, field, _cfield(field))
+
+
+@_add_metaclass(CObjectType)
 class CObject(object):
     ''' A pythonic representation of a C "object"
 
@@ -1010,8 +3483,22 @@ class CObject(object):
         >>> p.y
         2
 
+    Native objects can be pooled by setting ``_cpool`` to the number of freed
+    objects to keep for reuse. Instead of ``_cdel`` being called, a released
+    object goes on a free list and the next instance is given a recycled
+    pointer, which is re-initialized by calling the ``_creset`` method with the
+    constructor arguments. Counters are available from ``pool_stats()``.
+
     You can also specify a destructor with a ``_cdel`` method in the same way
-    as ``_cnew``.
+    as ``_cnew``. When ``_cnew`` returns a pointer the destructor is attached
+    to it with ``ffi.gc``, so it runs as soon as the last reference to the
+    pointer goes away rather than whenever ``__del__`` gets around to it. To
+    release the native resource eagerly call ``close()`` or use the object as
+    a context manager::
+
+        >>> with Point(4, 2) as p:
+        ...     p.x
+        4
 
     Alternatively you can assign a CFFI compatible object (either an actual
     CFFI CData object, or something CFFI automatically converts like and int)
@@ -1032,7 +3519,9 @@ class CObject(object):
         4
 
     If _cdata is set, attributes of the cdata object can also be retrieved from
-    the CObject instance, e.g., for struct fields, etc.
+    the CObject instance, e.g., for struct fields, etc. Declaring the type of
+    ``_cdata`` with ``_ctype`` makes reading struct fields faster (see
+    ``CObjectType``).
 
     libexample cdef::
 
@@ -1061,14 +3550,103 @@ class CObject(object):
 
     '''
 
+    _cdata = None
+    _cgc = False  # True when _cdel has been attached to _cdata with ffi.gc
+    _closed = False
+
+    _cpool = 0
+
     def __init__(self, *args, **kwargs):
         if not hasattr(self, '_cdata') or self._cdata is None:
             if hasattr(self, '_cnew'):
-                # C functions don't accept kwargs, so we just ignore them.
-                self._cdata = self._cnew(*args)
+                pool = self._cfreelist() if self._cpool else None
+                cdata = pool.get() if pool is not None else None
+                if cdata is not None:
+                    self._cdata = self._cown(cdata)
+                    self._creset(*args)
+                else:
+                    # C functions don't accept kwargs, so we just ignore them.
+                    self._cdata = self._cown(self._cnew(*args))
+                if _live_objects is not None and hasattr(type(self), '_cdel'):
+                    _track_object(self, type(self).__name__)
             else:
                 self._cdata = None
 
+    @classmethod
+    def _cfreelist(cls):
+        ''' The free list of native objects for this class, see ``_cpool``. '''
+
+        pool = cls.__dict__.get('_cpool_freelist')
+        if pool is None:
+            cfunc = getattr(getattr(cls, '_cdel', None), 'cfunc', None)
+            if cfunc is None or not hasattr(cls, '_creset'):
+                raise TypeError('{0} needs _cdel (a cmethod) and _creset to be pooled'
+                                .format(cls.__name__))
+            pool = FreeList(cls._cpool, cfunc.cfunc)
+            name = cls.__module__ + '.' + getattr(cls, '__qualname__', cls.__name__)
+            cls._cpool_freelist = _pools[name] = pool
+        return pool
+
+    def _cown(self, cdata):
+        ''' Attaches the class's ``_cdel`` to a pointer returned by ``_cnew``
+        with ``ffi.gc``, when ``_cdel`` is a ``cmethod``. Anything else is
+        returned unchanged and left for ``__del__`` to clean up.
+
+        A ``CStruct`` returned by a constructor paired with its destructor
+        (see ``CFunction.set_destructor``) already owns its pointer, so the
+        pointer is unwrapped and kept as it is. '''
+
+        if isinstance(cdata, CStruct):
+            self._cgc = True
+            return cdata._cdata
+        cls = type(self)
+        cfunc = getattr(getattr(cls, '_cdel', None), 'cfunc', None)
+        if cfunc is None:
+            # A python _cdel has to be called as a method, by __del__
+            return cdata
+        ffi = _cfunc_ffi(getattr(cls, '_cnew', None))
+        if not isinstance(cdata, ffi.CData) or ffi.typeof(cdata).kind != 'pointer':
+            return cdata
+        # The destructor must not reference self, otherwise the pointer would
+        # keep its own owner alive.
+        if cls._cpool:
+            destructor = cls._cfreelist().put
+        else:
+            destructor = cfunc.cfunc
+        cdata = ffi.gc(cdata, destructor)
+        self._cgc = True
+        return cdata
+
+    def close(self):
+        ''' Releases the native resource held in ``_cdata`` now, calling
+        ``_cdel`` if the class has one. Safe to call more than once. '''
+
+        if self._closed:
+            return
+        self._closed = True
+        cdata = self._cdata
+        if cdata is None:
+            return
+        if self._cgc:
+            ffi = _cfunc_ffi(getattr(type(self), '_cnew', None))
+            release = getattr(ffi, 'release', None)
+            if release is not None:
+                release(cdata)  # Runs the ffi.gc destructor immediately
+            elif hasattr(type(self), '_cdel'):
+                ffi.gc(cdata, None)
+                type(self)._cdel(cdata)
+        elif hasattr(type(self), '_cdel'):
+            self._cdel()
+        self._cdata = None
+        if _live_objects is not None:
+            _untrack_object(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def __getattr__(self, attr):
         if self._cdata is not None and hasattr(self._cdata, attr):
             return getattr(self._cdata, attr)
@@ -1077,7 +3655,10 @@ class CObject(object):
                                  .format(repr(self.__class__), repr(attr)))
 
     def __del__(self):
-        if hasattr(self, '_cdel'):
+        # Only needed when _cdel couldn't be attached with ffi.gc, e.g. for
+        # handles which are plain ints.
+        if (not self._cgc and not self._closed and self._cdata is not None
+                and hasattr(type(self), '_cdel')):
             self._cdel()
 
 
@@ -1085,13 +3666,31 @@ class nparray(object):
     """
     For use with cffi arrays, return a numpy reference to them that also holds
     a reference to the c data to ensure it stays alive
-    :param cffi.CData cdata: array object, expected to be uint8_t or equivalent
+    :param cffi.CData cdata: array object, expected to be uint8_t or equivalent,
+                             or a size in bytes to allocate a new zeroed array
+    :param dtype: numpy dtype of the array, uint8 if not given
+    :param int align: byte alignment of newly allocated arrays. For an existing
+                      array, ValueError is raised if it isn't aligned
     :return: wrapped numpy array object
     """
-    def __init__(self, _cdata, size=-1, dtype=numpy.uint8):
+    def __init__(self, _cdata, size=-1, dtype=None, align=None):
+        ffi = _globalffi()
+        if isinstance(_cdata, _integer_types):
+            ctype = ffi.getctype('uint8_t', '[%i]' % _cdata)
+            if align:
+                _cdata = _aligned_new(ffi, ctype, align, origin='nparray')
+            else:
+                _cdata = ffi.new(ctype)
+                if _alloc_sites is not None:
+                    _track(ffi, _cdata, 'nparray', None)
+        elif align and int(ffi.cast('uintptr_t', _cdata)) % align:
+            raise ValueError('cdata is not aligned to {0} bytes'.format(align))
         self.__cdata = _cdata
-        self.__buff = _global_ffi.buffer(_cdata, size=size)
-        self.__nparray = numpy.frombuffer(self.__buff, dtype=dtype)
+        self.__buff = ffi.buffer(_cdata, size=size)
+        numpy = _numpy()
+        if numpy is None:
+            raise NotImplementedError("numpy module required")
+        self.__nparray = numpy.frombuffer(self.__buff, dtype=numpy.uint8 if dtype is None else dtype)
 
     def __getattr__(self, item):
         return getattr(self.__nparray, item)
@@ -1109,34 +3708,64 @@ class nparray(object):
     def ndarray(self):
         return self.__nparray
 
+    def __reduce_ex__(self, protocol):
+        return (_unpickle_nparray,
+                (self.__nparray.dtype.str, _pickle_data(self.__buff, protocol)))
+
 
 def nparrayptr(nparr, offset=0):
     ''' Convenience function for getting the CFFI-compatible pointer to a numpy
     array object. '''
 
-    if _global_ffi:
-        return _global_ffi.cast('void *', nparr.__array_interface__['data'][0]+offset)
+    if cffi:
+        return _globalffi().cast('void *', nparr.__array_interface__['data'][0]+offset)
+
 
+def carray(items_or_size=None, size=None, ctype='int', allocator=None, align=None,
+           shared=False):
+    ''' Convenience function for creating C arrays.
 
-def carray(items_or_size=None, size=None, ctype='int'):
-    ''' Convenience function for creating C arrays. '''
+    ``allocator`` is an optional allocator (see ``allocator()``), otherwise the
+    module default allocator or ``ffi.new`` is used. ``align`` optionally gives
+    the byte alignment of the start of the array. With ``shared`` the array is
+    allocated in shared memory and a ``SharedArray`` handle is returned.
+
+    '''
 
     # TODO: Support multi-dimensional arrays? Maybe it's just easier to stick
     # with numpy...
 
-    if _global_ffi:
+    if cffi:
+        ffi = _globalffi()
         if isinstance(items_or_size, int) and size is None:
             size = items_or_size
             items = None
         else:
             items = items_or_size
 
-        if items and size > len(items):
-            size = max(len(items), size or 0)
-            arr = _global_ffi.new(_global_ffi.getctype(ctype, '[]'), size)
+        if align or shared:
+            length = max(len(items), size or 0) if items else size
+            arrtype = ffi.getctype(ctype, '[%i]' % length)
+            if shared:
+                handle = SharedArray(ffi, arrtype)
+                arr = handle.array
+            else:
+                arr = _aligned_new(ffi, arrtype, align, allocator, 'carray', ctype)
+            if items:
+                arr[0:len(items)] = items
+            return handle if shared else arr
+
+        new = allocator or _default_allocator or ffi.new
+        # As in _new, the allocator may be from an FFI which can't parse
+        # this FFI's type names.
+        arrtype = ffi.typeof(ffi.getctype(ctype, '[]'))
+        if items and size is not None and size > len(items):
+            arr = new(arrtype, size)
             for i, elem in enumerate(items):
                 arr[i] = elem
-            return arr
         else:
-            return _global_ffi.new(_global_ffi.getctype(ctype, '[]'), items or size)
+            arr = new(arrtype, items or size)
+        if _alloc_sites is not None:
+            _track(ffi, arr, 'carray', ctype)
+        return arr
 
@@ -0,0 +1,6 @@
+#!/bin/bash
+
+make -C tests >/dev/null
+
+export PYTHONPATH="$PWD:$PWD/tests:$PYTHONPATH"
+python tests/bench_wrapc.py "$@"
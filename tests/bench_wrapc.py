@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# Copyright (c) 2016, Andrew Leech <andrew@alelec.net>
+# All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# The full license is also available in the file LICENSE.apache-2.0.txt
+
+''' Times each cfficloak call path against raw cffi, using the test library.
+
+Run with ./run-bench.sh, see --help for the options. Results are written as
+JSON so runs can be compared with --compare.
+
+With --threads and/or --processes the benchmarks are instead run
+concurrently by 1 up to N workers for --duration seconds, reporting calls/sec
+and the scaling efficiency against a single worker. The work/* benchmarks
+spend a controllable time (--work) in C with the GIL released, so any
+serialization in the wrapper shows up separately from C time.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import platform
+import sys
+import threading
+import time
+import timeit
+
+import cffi
+import cfficloak as wrap
+from cfficloak import cmethod
+
+from test_wrapc import ffi, api, cfuncs, MyInt1, MyOutInt, MyInt4
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+### Workloads ###
+
+# Each workload returns a dict of benchmark name -> zero argument callable,
+# with any setup done up front so only the call itself is timed.
+
+def scalar_calls():
+    one = MyInt1(1)
+    myint_succ = cfuncs['myint_succ']
+    raw_succ = api.myint_succ
+    return {
+        'scalar/raw': lambda: raw_succ(1),
+        'scalar/cfunction': lambda: myint_succ(1),
+        'scalar/cmethod': lambda: one.add(2),
+        'scalar/cproperty': lambda: one.succ,
+    }
+
+
+def outarg_calls():
+    myout = MyOutInt(1)
+    raw = api.complicated
+    out = ffi.new('float *')
+    inout = ffi.new('int *', 8)
+    inout2 = ffi.new('double *', 3.14)
+    return {
+        'outargs/raw': lambda: raw(1, out, inout, 30, inout2),
+        'outargs/cmethod': lambda: myout.complicated(30, 8, 3.14),
+        'outargs/cmethod_arena': lambda: _in_arena(myout.complicated, 30, 8, 3.14),
+        'inoutargs/cmethod': lambda: myout.addp(7),
+    }
+
+
+def _in_arena(func, *args):
+    with wrap.arena(1024):
+        return func(*args)
+
+
+def array_calls():
+    four = MyInt4(4)
+    raw = api.myint_add_array
+    carr = ffi.new('int[]', [1, 2, 3])
+    items = [1, 2, 3]
+    calls = {
+        'arrays/raw_carray': lambda: raw(4, carr, 3),
+        'arrays/cmethod_carray': lambda: four.add_array(carr, 3),
+        'arrays/cmethod_list': lambda: four.add_array(items, 3),
+        'arrays/cmethod_int': lambda: four.add_array(3, 3),
+    }
+    if numpy is not None:
+        nparr = numpy.arange(3, dtype=numpy.int32)
+        calls['arrays/cmethod_numpy'] = lambda: four.add_array(nparr, 3)
+    return calls
+
+
+def string_calls():
+    raw = api.mystr_len
+    mystr_len = cfuncs['mystr_len']
+    mystr_name = cfuncs['mystr_name']
+    return {
+        'strings/raw_bytes': lambda: raw(b'cfficloak'),
+        'strings/cfunction_bytes': lambda: mystr_len(b'cfficloak'),
+        'strings/cfunction_text': lambda: mystr_len(u'cfficloak'),
+        'strings/cfunction_char_p_return': lambda: mystr_name(1),
+    }
+
+
+def struct_calls():
+    point_t = wrap.CStructType(ffi, 'point_t')
+    raw = ffi.new('point_t *', [1, 2])
+    point = point_t(1, 2)
+
+    def set_raw():
+        raw.x = 3
+
+    def set_wrapped():
+        point.x = 3
+
+    return {
+        'struct/raw_get': lambda: raw.x,
+        'struct/cstruct_get': lambda: point.x,
+        'struct/raw_set': set_raw,
+        'struct/cstruct_set': set_wrapped,
+        'struct/raw_new': lambda: ffi.new('point_t *', [1, 2]),
+        'struct/cstructtype_new': lambda: point_t(1, 2),
+        'struct/cstructtype_new_kw': lambda: point_t(x=1, y=2),
+    }
+
+
+def enum_calls():
+    color_t = ffi.typeof('color_t')
+    mycolor = cfuncs['mycolor']
+    raw = api.mycolor
+    return {
+        'enum/raw_return': lambda: raw(1),
+        'enum/cfunction_return': lambda: mycolor(1),
+        'enum/wrapenum': lambda: wrap.wrapenum(5, color_t),
+    }
+
+
+# Iterations of work_spin per call of the work/* benchmarks, see --work
+work_iterations = 1000
+
+
+def work_calls():
+    raw = api.work_spin
+    work_spin = cfuncs['work_spin']
+    work_sleep = cfuncs['work_sleep']
+    n = work_iterations
+
+    class Worker(wrap.CObject):
+        spin = cmethod(cfuncs['work_spin'])
+
+    worker = Worker()
+    worker._cdata = n
+    return {
+        'work/raw_spin': lambda: raw(n),
+        'work/cfunction_spin': lambda: work_spin(n),
+        'work/cmethod_spin': lambda: worker.spin(),
+        'work/cfunction_sleep': lambda: work_sleep(n // 1000),
+    }
+
+
+def startup_calls():
+    return {
+        'startup/wrapall': lambda: wrap.wrapall(ffi, api),
+    }
+
+
+workloads = [scalar_calls, outarg_calls, array_calls, string_calls,
+             struct_calls, enum_calls, work_calls, startup_calls]
+
+
+### Runner ###
+
+def benchmarks(pattern=None):
+    ''' All the benchmarks, optionally only those with ``pattern`` in their
+    name, sorted by name. '''
+    calls = {}
+    for workload in workloads:
+        calls.update(workload())
+    return sorted((name, func) for name, func in calls.items()
+                  if pattern is None or pattern in name)
+
+
+def timecall(func, repeat=5, mintime=0.2):
+    ''' Returns the number of calls per run and the time per call in
+    nanoseconds of each of ``repeat`` runs. Runs are sized to take at least
+    ``mintime`` seconds. '''
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= mintime:
+            break
+        number = max(number * 2, int(number * mintime / max(elapsed, 1e-9)))
+    runs = timer.repeat(repeat, number)
+    return number, [run * 1e9 / number for run in runs]
+
+
+def metadata():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'cffi': cffi.__version__,
+        'numpy': numpy.__version__ if numpy is not None else None,
+        'cfficloak': wrap.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def run(pattern=None, repeat=5, mintime=0.2, out=sys.stdout):
+    results = {}
+    for name, func in benchmarks(pattern):
+        number, runs = timecall(func, repeat, mintime)
+        results[name] = {'number': number, 'runs': runs, 'best': min(runs)}
+        print('{0:40} {1:10.1f} ns'.format(name, min(runs)), file=out)
+    return {'meta': metadata(), 'results': results}
+
+
+def compare(old, new, out=sys.stdout):
+    ''' Prints the best times of two result sets side by side. '''
+    for name in sorted(new['results']):
+        best = new['results'][name]['best']
+        before = old['results'].get(name)
+        if before is None:
+            print('{0:40} {1:10.1f} ns'.format(name, best), file=out)
+        else:
+            print('{0:40} {1:10.1f} ns {2:10.1f} ns {3:+7.1%}'.format(
+                name, before['best'], best, best / before['best'] - 1), file=out)
+
+
+### Concurrent throughput ###
+
+def count_calls(func, duration, batch=64):
+    ''' Calls ``func`` for about ``duration`` seconds, returning the number of
+    calls made and the time they took. The clock is only read every ``batch``
+    calls. '''
+    clock = timeit.default_timer
+    calls = 0
+    start = clock()
+    end = start + duration
+    now = start
+    while now < end:
+        for _ in range(batch):
+            func()
+        calls += batch
+        now = clock()
+    return calls, now - start
+
+
+def _thread_worker(func, duration, start, counts):
+    start.wait()
+    counts.append(count_calls(func, duration))
+
+
+def _process_worker(name, pattern, work, duration, start, counts):
+    # Workloads are rebuilt by name, so this also works with spawn
+    global work_iterations
+    work_iterations = work
+    func = dict(benchmarks(pattern))[name]
+    start.wait()
+    counts.put(count_calls(func, duration))
+
+
+def run_concurrent(name, pattern, workers, duration, mode, timeout=60):
+    ''' Runs benchmark ``name`` in ``workers`` threads or processes at once,
+    returning the total calls/sec over the time the slowest one took.
+
+    The workers all start timing together, once every one of them is ready
+    (processes have imported and built the workload), or ``timeout`` seconds
+    have passed, which raises ``threading.BrokenBarrierError``. '''
+    if mode == 'thread':
+        func = dict(benchmarks(pattern))[name]
+        start = threading.Barrier(workers + 1)
+        counts = []
+        pool = [threading.Thread(target=_thread_worker, args=(func, duration, start, counts))
+                for _ in range(workers)]
+    else:
+        start = multiprocessing.Barrier(workers + 1)
+        counts = multiprocessing.Queue()
+        pool = [multiprocessing.Process(target=_process_worker,
+                                        args=(name, pattern, work_iterations, duration,
+                                              start, counts))
+                for _ in range(workers)]
+    for worker in pool:
+        worker.start()
+    try:
+        start.wait(timeout)
+    except threading.BrokenBarrierError:
+        start.abort()  # Release the workers which did get ready
+        for worker in pool:
+            worker.join()
+        raise
+    if mode == 'process':
+        counts = [counts.get() for _ in pool]
+    for worker in pool:
+        worker.join()
+    return sum(calls for calls, _ in counts) / max(elapsed for _, elapsed in counts)
+
+
+def worker_counts(maximum):
+    ''' 1, 2, 4, ... up to and including ``maximum``. '''
+    counts = []
+    n = 1
+    while n < maximum:
+        counts.append(n)
+        n *= 2
+    return counts + [maximum]
+
+
+def run_scaling(pattern=None, threads=0, processes=0, duration=1.0, out=sys.stdout):
+    results = {}
+    for mode, maximum in (('thread', threads), ('process', processes)):
+        if not maximum:
+            continue
+        modes = results[mode] = {}
+        for name, _ in benchmarks(pattern):
+            if name.startswith('startup/'):
+                continue
+            scaling = modes[name] = {}
+            single = None
+            for workers in worker_counts(maximum):
+                rate = run_concurrent(name, pattern, workers, duration, mode)
+                single = single or rate
+                efficiency = rate / (workers * single)
+                scaling[workers] = {'calls_per_sec': rate, 'efficiency': efficiency}
+                print('{0:8} {1:40} {2:3} {3:14.0f}/s {4:7.1%}'.format(
+                    mode, name, workers, rate, efficiency), file=out)
+    return {'meta': metadata(), 'work_iterations': work_iterations, 'scaling': results}
+
+
+def main(argv=None):
+    global work_iterations
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-k', dest='pattern', help='only run benchmarks with this in their name')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('-t', '--mintime', type=float, default=0.2,
+                        help='minimum seconds per timed run')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='measure throughput with up to this many threads')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='measure throughput with up to this many processes')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds each throughput measurement runs for')
+    parser.add_argument('--work', type=int, default=1000,
+                        help='C loop iterations per call of the work/* benchmarks, '
+                             'work/cfunction_sleep sleeps for 1/1000th of this in us')
+    args = parser.parse_args(argv)
+
+    work_iterations = args.work
+    if args.threads or args.processes:
+        results = run_scaling(args.pattern, args.threads, args.processes, args.duration)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return results
+
+    results = run(args.pattern, args.repeat, args.mintime,
+                  out=sys.stderr if args.compare else sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
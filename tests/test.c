@@ -19,6 +19,8 @@
 #include "test.h"
 #include <math.h>
 #include <stdlib.h>
+#include <errno.h>
+#include <time.h>
 
 
 /* MyInt test functions */
@@ -116,21 +118,57 @@ int myint_add_array(int j, int *a, int n)
     return 0;
 }
 
+/* Enum tests */
+color_t mycolor(int i)
+{
+    return (color_t)i;
+}
+
+/* Return handling test functions */
+char* mystr_name(int i)
+{
+    static char name[] = "cfficloak";
+    return i < 0 ? NULL : name;
+}
+
+int mystr_len(const char *s)
+{
+    int n = 0;
+    while (s[n])
+        n++;
+    return n;
+}
+
+int myint_errno(int e)
+{
+    errno = e;
+    return e ? -1 : 0;
+}
+
 /* Struct tests */
+static int points_alive = 0;
+
 point_t* make_point(int x, int y)
 {
     point_t* p;
     p = (point_t*)malloc(sizeof(point_t));
     p->x = x;
     p->y = y;
+    points_alive++;
     return p;
 }
 
 void del_point(point_t* p)
 {
+    points_alive--;
     free(p);
 }
 
+int point_count(void)
+{
+    return points_alive;
+}
+
 int point_x(point_t* p)
 {
     return p->x;
@@ -160,3 +198,22 @@ double point_dist(point_t* p1, point_t* p2)
     return d;
 }
 
+
+/* Throughput benchmark work, cffi releases the GIL around these */
+
+double work_spin(long n)
+{
+    volatile double x = 0;
+    long i;
+    for (i = 0; i < n; i++)
+        x += i * 0.5;
+    return x;
+}
+
+int work_sleep(int usec)
+{
+    struct timespec ts;
+    ts.tv_sec = usec / 1000000;
+    ts.tv_nsec = (usec % 1000000) * 1000L;
+    return nanosleep(&ts, NULL);
+}
@@ -42,6 +42,18 @@ double complicated(int in,
 
 int myint_add_array(int j, int *a, int n);
 
+typedef enum {
+    RED,
+    GREEN,
+    BLUE = 5
+} color_t;
+
+color_t mycolor(int i);
+
+char* mystr_name(int i);
+int mystr_len(const char *s);
+int myint_errno(int e);
+
 typedef struct {
     int x;
     int y;
@@ -54,3 +66,8 @@ int point_y(point_t* p);
 point_t* point_setx(point_t* p, int x);
 point_t* point_sety(point_t* p, int y);
 double point_dist(point_t* p1, point_t* p2);
+int point_count(void);
+
+/* Work done with the GIL released, for the throughput benchmarks */
+double work_spin(long n);
+int work_sleep(int usec);
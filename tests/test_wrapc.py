@@ -23,7 +23,10 @@
 
 from IPython.core.debugger import Pdb
 
+import io
 import os
+import pickle
+import sys
 
 from pytest import *
 
@@ -60,6 +63,18 @@ double complicated(int in,
 
 int myint_add_array(int j, int *a, int n);
 
+typedef enum {
+    RED,
+    GREEN,
+    BLUE = 5
+} color_t;
+
+color_t mycolor(int i);
+
+char* mystr_name(int i);
+int mystr_len(const char *s);
+int myint_errno(int e);
+
 typedef struct { 
     int x;
     int y;
@@ -72,6 +87,10 @@ int point_y(point_t* p);
 point_t* point_setx(point_t* p, int x);
 point_t* point_sety(point_t* p, int y);
 double point_dist(point_t* p1, point_t* p2);
+int point_count(void);
+
+double work_spin(long n);
+int work_sleep(int usec);
 ''')
 
 srcpath = os.path.dirname(os.path.abspath(__file__))
@@ -328,6 +347,594 @@ class TestCArrays:
         assert retval == 0
         assert list(retarr) == [4+4,2+4]
 
+## Custom allocators
+
+libc_ffi = cffi.FFI()
+libc_ffi.cdef('void *malloc(size_t size); void free(void *ptr);')
+libc = libc_ffi.dlopen(None)
+
+class TestAllocators:
+    @fixture
+    def counting_allocator(self):
+        calls = {'alloc': 0, 'free': 0}
+        def alloc(size):
+            calls['alloc'] += 1
+            return libc.malloc(size)
+        def free(ptr):
+            calls['free'] += 1
+            libc.free(ptr)
+        return wrap.allocator(alloc, free), calls
+
+    def test_carray_noclear(self):
+        a = wrap.carray(4, allocator=wrap.allocator(should_clear_after_alloc=False))
+        assert len(a) == 4
+        a = wrap.carray([1, 2], 4, allocator=wrap.allocator(should_clear_after_alloc=False))
+        assert list(a[0:2]) == [1, 2]
+
+    def test_custom_alloc_free(self, counting_allocator):
+        alloc, calls = counting_allocator
+        a = wrap.carray([1, 2], allocator=alloc)
+        assert list(a) == [1, 2]
+        assert calls['alloc'] == 1
+        del a
+        if not hasattr(sys, 'pypy_version_info'):
+            assert calls['free'] == 1
+
+    def test_carray_allocator_ctype(self):
+        # Allocators may come from another FFI, so get types not names
+        seen = []
+        def alloc(ctype, init=None):
+            seen.append(ctype)
+            return ffi.new(ctype, init)
+        assert list(wrap.carray([1, 2], allocator=alloc)) == [1, 2]
+        assert len(wrap.carray(4, allocator=alloc, align=16)) == 4
+        assert all(isinstance(ctype, ffi.CType) for ctype in seen)
+        assert len(seen) == 2
+
+    def test_struct_array_allocator(self, counting_allocator):
+        alloc, calls = counting_allocator
+        pa = wrap.CStructType(ffi, 'point_t').array(3, allocator=alloc)
+        assert len(pa) == 3
+        assert calls['alloc'] == 1
+
+    def test_cmethod_allocator(self, counting_allocator):
+        alloc, calls = counting_allocator
+        add_array = wrap.cmethod(cfuncs['myint_add_array'], arrays=[1],
+                                 allocator=alloc)
+        (retval, retarr) = add_array(2, [1, 2], 2)
+        assert list(retarr) == [3, 4]
+        assert calls['alloc'] == 1
+
+    def test_default_allocator(self, counting_allocator):
+        alloc, calls = counting_allocator
+        wrap.set_allocator(alloc)
+        try:
+            wrap.carray(8)
+        finally:
+            wrap.set_allocator(None)
+        assert calls['alloc'] == 1
+
+
+## Struct arrays mapped from files
+
+class TestFromFile:
+    @fixture
+    def points_file(self, tmpdir):
+        path = str(tmpdir.join('points.bin'))
+        pa = ffi.new('point_t[5]', [(i, i * 10) for i in range(5)])
+        with open(path, 'wb') as f:
+            f.write(b'header')
+            f.write(ffi.buffer(pa))
+        return path
+
+    def test_from_file(self, points_file):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        pa = point_t.from_file(points_file, offset=6)
+        assert len(pa) == 5
+        assert isinstance(pa[2], wrap.CStruct)
+        assert (pa[2].x, pa[2].y) == (2, 20)
+        assert pa[-1].x == 4
+        assert [p.x for p in pa[1:3]] == [1, 2]
+        with raises(IndexError):
+            pa[5]
+
+    def test_from_file_count(self, points_file):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        pa = point_t.from_file(points_file, offset=6, count=2)
+        assert len(pa) == 2
+        assert cfuncs['point_x'](pa[1]) == 1
+
+    def test_from_file_readonly(self, points_file):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        pa = point_t.from_file(points_file, offset=6)
+        pa[0].x = 99
+        pa = point_t.from_file(points_file, offset=6)
+        assert pa[0].x == 0
+
+    def test_from_file_writable(self, points_file):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        pa = point_t.from_file(points_file, offset=6, writable=True)
+        pa[0].x = 99
+        pa[1] = point_t(7, 8)
+        pa.flush()
+        pa = point_t.from_file(points_file, offset=6)
+        assert pa[0].x == 99
+        assert (pa[1].x, pa[1].y) == (7, 8)
+
+
+## Pickling
+
+class TestPickle:
+    def test_pickle_struct(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        p = pickle.loads(pickle.dumps(point_t(3, 4)))
+        assert isinstance(p, wrap.CStruct)
+        assert (p.x, p.y) == (3, 4)
+
+    def test_pickle_struct_array(self):
+        pa = wrap.CStructArray(ffi, ffi.new('point_t[3]', [(1, 2), (3, 4), (5, 6)]))
+        pa2 = pickle.loads(pickle.dumps(pa, protocol=2))
+        assert [(p.x, p.y) for p in pa2] == [(1, 2), (3, 4), (5, 6)]
+
+    def test_pickle_out_of_band(self):
+        if not hasattr(pickle, 'PickleBuffer'):
+            skip('pickle protocol 5 not available')
+        pa = wrap.CStructArray(ffi, ffi.new('point_t[1000]'))
+        pa[999].y = 9
+        buffers = []
+        data = pickle.dumps(pa, protocol=5, buffer_callback=buffers.append)
+        assert len(data) < 1000
+        pa2 = pickle.loads(data, buffers=buffers)
+        assert len(pa2) == 1000
+        assert pa2[999].y == 9
+
+    def test_pickle_nparray(self):
+        numpy = importorskip('numpy')
+        a = wrap.nparray(wrap.carray([1, 2, 3], ctype='int32_t'), dtype=numpy.int32)
+        a2 = pickle.loads(pickle.dumps(a))
+        assert list(a2.ndarray) == [1, 2, 3]
+        assert a2.dtype == numpy.int32
+
+    def test_pickle_unregistered_ffi(self):
+        other = cffi.FFI()
+        other.cdef('typedef struct { int a; } other_t;')
+        s = wrap.CStructType(other, 'other_t')(1)
+        with raises(pickle.PicklingError):
+            pickle.dumps(s)
+        wrap.register_ffi(other, 'other')
+        assert pickle.loads(pickle.dumps(s)).a == 1
+
+
+## Shared memory arrays
+
+def shared_worker(handle):
+    # Runs in a child process, the handle is attached by name when unpickled
+    for i, p in enumerate(handle):
+        p.y = p.x * 2
+    handle.close()
+
+class TestSharedArray:
+    def test_shared_struct_array(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with point_t.array(4, shared=True) as handle:
+            assert isinstance(handle, wrap.SharedArray)
+            assert len(handle) == 4
+            handle[1].x = 5
+            other = wrap.SharedArray.attach(handle.name, handle.ctype, ffi)
+            assert other[1].x == 5
+            other[2].y = 6
+            assert handle[2].y == 6
+            other.close()
+
+    def test_shared_carray(self):
+        with wrap.carray([1, 2, 3], shared=True) as handle:
+            assert list(handle.array) == [1, 2, 3]
+            cfuncs['myint_add_array'](1, handle.array, 3)
+            assert list(handle.array) == [2, 3, 4]
+
+    def test_pickle_attaches(self):
+        with wrap.carray(4, shared=True) as handle:
+            other = pickle.loads(pickle.dumps(handle))
+            assert other.name == handle.name and not other.owner
+            other.array[3] = 7
+            assert handle.array[3] == 7
+            other.close()
+
+    def test_owner_unlinks(self):
+        handle = wrap.carray(8, shared=True)
+        name = handle.name
+        handle.close()
+        with raises(FileNotFoundError):
+            wrap.SharedArray.attach(name, 'int[8]')
+
+    def test_views_keep_handle(self):
+        import gc
+        arr = wrap.carray([1, 2, 3], shared=True).array
+        gc.collect()
+        assert list(arr) == [1, 2, 3]
+        point_t = wrap.CStructType(ffi, 'point_t')
+        handle = point_t.array(2, shared=True)
+        handle[1].x = 4
+        p = handle[1]
+        del handle
+        gc.collect()
+        assert p.x == 4
+
+    def test_unlinked_without_gc(self):
+        import gc
+        point_t = wrap.CStructType(ffi, 'point_t')
+        gc.disable()
+        try:
+            for make in (lambda: wrap.carray(4, shared=True),
+                         lambda: point_t.array(4, shared=True)):
+                handle = make()
+                name, ctype = handle.name, handle.ctype
+                del handle
+                with raises(FileNotFoundError):
+                    wrap.SharedArray.attach(name, ctype, ffi)
+                handle = make()
+                name, arr = handle.name, handle.array
+                del handle
+                assert len(arr) == 4
+                wrap.SharedArray.attach(name, ctype, ffi).close()
+                del arr
+                with raises(FileNotFoundError):
+                    wrap.SharedArray.attach(name, ctype, ffi)
+        finally:
+            gc.enable()
+
+    def test_shared_multiprocess(self):
+        import multiprocessing
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            skip('fork start method not available')
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with point_t.array(3, shared=True) as handle:
+            for i, p in enumerate(handle):
+                p.x = i + 1
+            proc = ctx.Process(target=shared_worker, args=(handle,))
+            proc.start()
+            proc.join()
+            assert proc.exitcode == 0
+            assert [p.y for p in handle] == [2, 4, 6]
+
+
+def ring_producer(ring, count):
+    for i in range(count):
+        while not ring.push(i, -i):
+            pass
+    ring.close()
+
+class TestStructRing:
+    def test_push_pop(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with wrap.StructRing(point_t, 4) as ring:
+            assert ring.pop() is None
+            assert ring.push(1, 2) and ring.push(x=3)
+            assert len(ring) == 2
+            p = ring.pop()
+            assert (p.x, p.y) == (1, 2)
+            p = ring.pop()
+            assert (p.x, p.y) == (3, 0)
+            assert ring.pop() is None
+            assert len(ring) == 0
+
+    def test_full_and_wrap(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with wrap.StructRing(point_t, 4) as ring:
+            for i in range(4):
+                assert ring.push(x=i)
+            assert not ring.push(x=4)
+            assert ring.pop().x == 0
+            # The popped slot isn't free until released
+            assert not ring.push(x=4)
+            ring.release()
+            assert ring.push(x=4)
+            # Drained views stop at the end of the slots
+            assert [p.x for p in ring.drain()] == [1, 2, 3]
+            assert [p.x for p in ring.drain()] == [4]
+            assert len(ring.drain()) == 0
+
+    def test_reserve(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with wrap.StructRing(point_t, 2) as ring:
+            slot = ring.reserve()
+            slot.x = 7
+            assert ring.pop() is None
+            ring.commit()
+            assert ring.pop().x == 7
+
+    def test_capacity(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with raises(ValueError):
+            wrap.StructRing(point_t, 3)
+
+    def test_attach(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with wrap.StructRing(point_t, 8) as ring:
+            other = pickle.loads(pickle.dumps(ring))
+            assert other.capacity == 8
+            other.push(5, 6)
+            assert ring.pop().y == 6
+            other.close()
+            small = cffi.FFI()
+            small.cdef('typedef struct { int a; } small_t;')
+            with raises(ValueError):
+                wrap.StructRing.attach(ring.name, wrap.CStructType(small, 'small_t'))
+
+    def test_multiprocess(self):
+        import multiprocessing
+        try:
+            ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            skip('fork start method not available')
+        point_t = wrap.CStructType(ffi, 'point_t')
+        count = 5000
+        with wrap.StructRing(point_t, 64) as ring:
+            proc = ctx.Process(target=ring_producer, args=(ring, count))
+            proc.start()
+            got = []
+            while len(got) < count:
+                for p in ring.drain():
+                    got.append((p.x, p.y))
+            proc.join()
+            assert proc.exitcode == 0
+            assert got == [(i, -i) for i in range(count)]
+
+
+## Streaming struct records
+
+class TrickleReader(object):
+    ''' Returns at most 5 bytes per read, to split records across reads. '''
+    def __init__(self, data):
+        self.f = io.BytesIO(data)
+    def readinto(self, b):
+        return self.f.readinto(b[:5])
+
+class TestStream:
+    @fixture
+    def points_data(self):
+        return bytes(ffi.buffer(ffi.new('point_t[10]', [(i, -i) for i in range(10)])))
+
+    def test_stream_batches(self, points_data):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        batches = [[(p.x, p.y) for p in batch]
+                   for batch in point_t.stream(io.BytesIO(points_data), batch=4)]
+        assert [len(b) for b in batches] == [4, 4, 2]
+        assert sum(batches, []) == [(i, -i) for i in range(10)]
+
+    def test_stream_partial_reads(self, points_data):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        xs = [p.x for batch in point_t.stream(TrickleReader(points_data), batch=3)
+              for p in batch]
+        assert xs == list(range(10))
+
+    def test_stream_truncated(self, points_data):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        with raises(EOFError):
+            for batch in point_t.stream(io.BytesIO(points_data[:-1])):
+                pass
+
+    def test_stream_socket(self, points_data):
+        import socket
+        point_t = wrap.CStructType(ffi, 'point_t')
+        a, b = socket.socketpair()
+        with a, b:
+            a.sendall(points_data)
+            a.shutdown(socket.SHUT_WR)
+            xs = [p.x for batch in point_t.stream(b, batch=8) for p in batch]
+        assert xs == list(range(10))
+
+
+## Vectored writes
+
+class TestStructWriter:
+    def test_write_structs(self, tmpdir):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        points = [point_t(i, i + 1) for i in range(100)]
+        path = str(tmpdir.join('out.bin'))
+        with open(path, 'wb') as f:
+            with wrap.StructWriter(f) as w:
+                w.writemany(points)
+            assert w.syscalls == 1
+        with open(path, 'rb') as f:
+            data = f.read()
+        assert data == b''.join(bytes(ffi.buffer(p._cdata)) for p in points)
+
+    def test_write_mixed(self):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        pa = ffi.new('point_t[100]', [(i, i) for i in range(100)])
+        expected = bytes(ffi.buffer(point_t(1, 2)._cdata)) + bytes(ffi.buffer(pa))
+        r, w = os.pipe()
+        try:
+            writer = wrap.StructWriter(w, coalesce=16)
+            writer.write(point_t(1, 2))
+            writer.write(wrap.CStructArray(ffi, pa))
+            writer.flush()
+            assert writer.syscalls == 1
+            assert os.read(r, len(expected) + 1) == expected
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_write_socket(self):
+        import socket
+        numpy = importorskip('numpy')
+        a, b = socket.socketpair()
+        with a, b:
+            with wrap.StructWriter(a, batch_bytes=8) as writer:
+                writer.write(numpy.arange(4, dtype=numpy.int32))
+            assert b.recv(100) == numpy.arange(4, dtype=numpy.int32).tobytes()
+
+
+## mmap allocations
+
+class TestMmapAllocator:
+    def test_carray_mmap(self):
+        a = wrap.carray(1024, allocator=wrap.MmapAllocator(prefault=True))
+        assert len(a) == 1024
+        assert a[1023] == 0
+        a[1023] = 7
+        assert a[1023] == 7
+        a = wrap.carray([1, 2], allocator=wrap.MmapAllocator())
+        assert list(a) == [1, 2]
+
+    def test_hugepage_rounding(self):
+        mapping = wrap.MmapAllocator().map(wrap.MmapAllocator.hugepage_size + 1)
+        assert len(mapping) == 2 * wrap.MmapAllocator.hugepage_size
+
+    def test_hugepage_aligned(self):
+        size = wrap.MmapAllocator.hugepage_size
+        for prefault in (False, True):
+            a = wrap.carray(size, ctype='uint8_t',
+                            allocator=wrap.MmapAllocator(prefault=prefault))
+            assert int(ffi.cast('uintptr_t', a)) % size == 0
+            assert len(a) == size
+            a[size - 1] = 3
+            assert a[size - 1] == 3
+
+    def test_struct_array_mmap(self):
+        pa = wrap.CStructType(ffi, 'point_t').array(10, allocator=wrap.MmapAllocator())
+        assert len(pa) == 10
+        pa[9].y = 4
+        assert pa[9].y == 4
+
+    def test_file_backed(self, tmpdir):
+        path = str(tmpdir.join('points.bin'))
+        point_t = wrap.CStructType(ffi, 'point_t')
+        pa = point_t.array(4, allocator=wrap.MmapAllocator(path))
+        pa[3].x = 42
+        del pa
+        assert os.path.getsize(path) == 4 * ffi.sizeof('point_t')
+        pa = point_t.array(4, allocator=wrap.MmapAllocator(path))
+        assert pa[3].x == 42
+
+
+## Aligned allocations
+
+def address(cdata):
+    return int(ffi.cast('uintptr_t', cdata))
+
+class TestAligned:
+    def test_carray_align(self):
+        a = wrap.carray([1, 2, 3], align=64)
+        assert address(a) % 64 == 0
+        assert list(a) == [1, 2, 3]
+
+    def test_struct_array_align(self):
+        pa = wrap.CStructType(ffi, 'point_t').array(5, align=64)
+        assert address(pa) % 64 == 0
+        assert len(pa) == 5
+        pa[4].x = 3
+        assert pa[4].x == 3
+
+    def test_cmethod_align_new_array(self):
+        add_array = wrap.cmethod(cfuncs['myint_add_array'], arrays=[1], align=64)
+        (retval, retarr) = add_array(2, [1, 2], 2)
+        assert address(retarr) % 64 == 0
+        assert list(retarr) == [3, 4]
+
+
+## Native allocation accounting
+
+class TestAllocationStats:
+    @fixture
+    def tracking(self):
+        wrap.allocation_stats(reset=True)
+        wrap.track_allocations()
+        yield
+        wrap.track_allocations(False)
+
+    def test_call_temporaries(self, tracking):
+        set_ptr_succ = wrap.cmethod(cfuncs['set_ptr_succ'], outargs=[1])
+        set_ptr_succ(3)
+        add_array = wrap.cmethod(cfuncs['myint_add_array'], arrays=[1])
+        add_array(1, [1, 2, 3], 3)
+        sites = wrap.allocation_stats()['sites']
+        outarg = sites[('outarg', 'set_ptr_succ')]
+        assert outarg['allocs'] == 1 and outarg['total'] == ffi.sizeof('int')
+        array = sites[('array', 'myint_add_array')]
+        assert array['peak'] == 3 * ffi.sizeof('int')
+        if not hasattr(sys, 'pypy_version_info'):
+            assert outarg['live'] == 0 and array['live'] == 0
+
+    def test_live_and_peak(self, tracking):
+        point_t = wrap.CStructType(ffi, 'point_t')
+        points = [point_t(1, 2) for _ in range(3)]
+        arr = wrap.carray(10)
+        stats = wrap.allocation_stats()
+        struct = stats['sites'][('struct', point_t.cname)]
+        assert struct['live'] == 3 * ffi.sizeof('point_t') and struct['count'] == 3
+        assert stats['sites'][('carray', 'int')]['live'] == 10 * ffi.sizeof('int')
+        assert stats['total']['live'] >= struct['live'] + 10 * ffi.sizeof('int')
+        if not hasattr(sys, 'pypy_version_info'):
+            del points[:], arr
+            struct = wrap.allocation_stats(reset=True)['sites'][('struct', point_t.cname)]
+            assert struct['live'] == 0 and struct['peak'] == 3 * ffi.sizeof('point_t')
+            assert ('struct', point_t.cname) not in wrap.allocation_stats()['sites']
+
+    def test_aligned_and_arena(self, tracking):
+        wrap.carray(4, align=64)
+        add_array = wrap.cmethod(cfuncs['myint_add_array'], arrays=[1])
+        with wrap.arena(1024):
+            add_array(1, [1, 2], 2)
+        sites = wrap.allocation_stats()['sites']
+        assert sites[('carray', 'int')]['total'] == 4 * ffi.sizeof('int') + 63
+        assert sites[('arena', None)]['total'] == 1024
+        assert ('array', 'myint_add_array') not in sites
+
+    def test_off(self):
+        wrap.allocation_stats(reset=True)
+        wrap.carray(10)
+        assert wrap.allocation_stats()['sites'] == {}
+
+
+## Arena allocated temporaries
+
+class TestArena:
+    @fixture(scope='class')
+    def myoutone(self):
+        return MyOutInt(1)
+
+    @fixture(scope='class')
+    def myfour(self):
+        return MyInt4(4)
+
+    def test_arena_outargs(self, myoutone):
+        with wrap.arena() as a:
+            assert myoutone.setp() == (42, 2)
+            assert myoutone.complicated(30, 8, 3.14) == (42.0, 2.0, 31, 11.14)
+            assert a.used > 0
+            assert len(a.blocks) == 1
+        assert a.blocks == []
+
+    def test_arena_array(self, myfour):
+        with wrap.arena():
+            (retval, retarr) = myfour.add_array([4, 2], 2)
+            assert retval == 0
+            assert list(retarr) == [4+4, 2+4]
+            (retval, retarr) = myfour.add_array(3, 3)
+            assert list(retarr) == [4, 4, 4]
+
+    def test_arena_grows(self):
+        with wrap.arena(size=64) as a:
+            a.new(ffi, 'int[]', 100)
+            a.new(ffi, 'int[]', 2)
+            assert len(a.blocks) == 2
+
+    def test_arena_string(self):
+        with wrap.arena() as a:
+            s = a.new(ffi, 'char[]', b'hello')
+            assert ffi.string(s) == b'hello'
+
+    def test_arena_nested(self, myfour):
+        with wrap.arena() as outer:
+            with wrap.arena() as inner:
+                myfour.add_array([1, 2], 2)
+            assert inner.used and not outer.used
+
+
 ## numpy arrays
 
 try:
@@ -353,9 +960,278 @@ try:
             (retval, retarr) = myfive.add_array(np_a, len(np_a))
             assert retval == 0
             assert list(np_a) == [8+5,9+5]
+
+    class TestNPAligned:
+        def test_nparray_align(self):
+            a = wrap.nparray(256, align=64)
+            assert a.ndarray.__array_interface__['data'][0] % 64 == 0
+            assert len(a) == 256
+
+        def test_nparray_misaligned(self):
+            a = wrap.carray(8, ctype='uint8_t', align=64)
+            with raises(ValueError):
+                wrap.nparray(ffi.cast('uint8_t *', a) + 1, size=4, align=64)
+
+        def test_cmethod_align_copy(self):
+            add_array = wrap.cmethod(cfuncs['myint_add_array'], arrays=[1],
+                                     align=64)
+            np_a = numpy.zeros(17, dtype=numpy.int32)[1:]
+            assert np_a.__array_interface__['data'][0] % 64
+            np_a[:] = numpy.arange(16)
+            _, ptr = add_array(1, np_a, len(np_a))
+            assert list(np_a) == list(range(1, 17))
+            # The returned pointer is in to np_a, not the freed scratch space
+            assert int(ffi.cast('uintptr_t', ptr)) == np_a.__array_interface__['data'][0]
+
+        def test_cmethod_align_raise(self):
+            add_array = wrap.cmethod(cfuncs['myint_add_array'], arrays=[1],
+                                     align=64, unaligned='raise')
+            np_a = numpy.zeros(17, dtype=numpy.int32)[1:]
+            with raises(ValueError):
+                add_array(1, np_a, len(np_a))
 except ImportError:
     pass
 
+## Enum tests
+
+class TestEnum:
+    def test_enum_return(self):
+        c = cfuncs['mycolor'](5)
+        assert isinstance(c, wrap.Enum)
+        assert c == 5
+        assert str(c) == 'BLUE'
+
+    def test_enum_interned(self):
+        assert cfuncs['mycolor'](1) is cfuncs['mycolor'](1)
+        assert type(cfuncs['mycolor'](0)) is type(cfuncs['mycolor'](5))
+
+    def test_enum_undeclared(self):
+        c = cfuncs['mycolor'](3)
+        assert c == 3
+        assert str(c) == '3'
+
+    def test_wrapall_enum_values(self):
+        assert cfuncs['GREEN'] is cfuncs['mycolor'](1)
+
+    def test_wrapenum_array(self):
+        numpy = importorskip('numpy')
+        codes = numpy.array([[0, 5], [3, 1]], dtype=numpy.int32)
+        names = wrap.wrapenum_array(codes, ffi.typeof('color_t'))
+        assert names.shape == (2, 2)
+        assert names.tolist() == [['RED', 'BLUE'], ['3', 'GREEN']]
+
+
+## Return handling tests
+
+class TestReturnHandling:
+    def test_scalar_no_check(self):
+        assert cfuncs['myint_succ']._checkerr is None
+        assert cfuncs['myfloat_succ']._convert is None
+
+    def test_pointer_null_check(self):
+        with raises(wrap.NullError) as exc:
+            cfuncs['myintp_null'](3)
+        assert exc.value.args[0] is cfuncs['myintp_null']
+        assert 'args (3,)' in str(exc.value)
+
+    def test_null_error_message(self):
+        assert str(wrap.NullError('plain message')) == 'plain message'
+
+    def test_char_p_string(self):
+        assert cfuncs['mystr_name'](1) == b'cfficloak'
+
+    def test_char_p_null(self):
+        with raises(wrap.NullError):
+            cfuncs['mystr_name'](-1)
+
+    def test_string_args(self):
+        assert cfuncs['mystr_len'](b'cloak') == 5
+        assert cfuncs['mystr_len'](u'cloak') == 5
+
+    def test_errnocheck(self):
+        import errno
+        myint_errno = wrap.cmethod(cfuncs['myint_errno'],
+                                   checkerr=wrap.errnocheck())
+        assert myint_errno(0) == 0
+        with raises(wrap.ErrnoError) as exc:
+            myint_errno(errno.ENOENT)
+        assert isinstance(exc.value, OSError)
+        assert exc.value.errno == errno.ENOENT
+        assert os.strerror(errno.ENOENT) in str(exc.value)
+
+
+## Call statistics
+
+class TestStats:
+    def test_enable_disable(self):
+        funcs = wrap.wrapall(ffi, api)
+        succ = funcs['myint_succ']
+        succ(1)
+        assert succ.stats is None
+        wrap.enable_stats([succ])
+        assert isinstance(succ, wrap.CFunction)
+        assert type(succ) is not wrap.CFunction
+        assert succ(1) == 2 and succ(2) == 3
+        assert succ.stats.calls == 2
+        assert 0 <= succ.stats.ctime <= succ.stats.total
+        assert succ.stats.max <= succ.stats.total
+        wrap.disable_stats([succ])
+        assert type(succ) is wrap.CFunction
+        assert succ._ccall is succ.cfunc
+        succ(3)
+        assert succ.stats.calls == 2
+
+    def test_errors_and_cmethod(self):
+        funcs = wrap.wrapall(ffi, api)
+        name = wrap.cmethod(funcs['mystr_name'])
+        wrap.enable_stats([name])
+        name(1)
+        with raises(wrap.NullError):
+            name(-1)
+        snapshot = wrap.stats(reset=True)['mystr_name']
+        assert snapshot['calls'] == 2 and snapshot['errors'] == 1
+        assert snapshot['marshal'] == snapshot['total'] - snapshot['ctime']
+        assert funcs['mystr_name'].stats.calls == 0
+        wrap.disable_stats(funcs)
+
+
+## Sampled call hooks
+
+class TestHooks:
+    def test_before_after(self):
+        funcs = wrap.wrapall(ffi, api)
+        calls = []
+        def before(call):
+            call.data = 'span'
+        def after(call):
+            calls.append((call.name, call.args, call.result, call.data,
+                          call.elapsed >= 0))
+        hook = wrap.add_hook(funcs, before, after)
+        assert funcs['myint_succ'](1) == 2
+        assert calls == [('myint_succ', (1,), 2, 'span', True)]
+        hook.remove()
+        assert type(funcs['myint_succ']) is wrap.CFunction
+        funcs['myint_succ'](1)
+        assert len(calls) == 1
+
+    def test_every(self):
+        funcs = wrap.wrapall(ffi, api)
+        calls = []
+        wrap.add_hook([funcs['myint_succ'], funcs['myfloat_succ']],
+                      after=calls.append, every=3)
+        for i in range(5):
+            funcs['myint_succ'](i)
+            funcs['myfloat_succ'](i)
+        # The count is shared between the functions
+        assert [(c.name, c.args) for c in calls] == \
+            [('myint_succ', (1,)), ('myfloat_succ', (2,)), ('myint_succ', (4,))]
+
+    def test_probability(self):
+        funcs = wrap.wrapall(ffi, api)
+        calls = []
+        wrap.add_hook(funcs['myint_succ'], after=calls.append, probability=0)
+        funcs['myint_succ'](1)
+        assert calls == []
+
+    def test_error_and_summary(self):
+        funcs = wrap.wrapall(ffi, api)
+        calls = []
+        wrap.add_hook(funcs, after=calls.append)
+        with raises(wrap.NullError):
+            funcs['mystr_name'](-1)
+        assert isinstance(calls[0].error, wrap.NullError)
+        assert calls[0].summary() == 'mystr_name(-1)'
+        arr = ffi.new('int[2]')
+        funcs['myint_add_array'](1, arr, 2)
+        assert calls[1].summary().startswith('myint_add_array(1, <int[2] 0x')
+
+    def test_with_stats(self):
+        funcs = wrap.wrapall(ffi, api)
+        succ = funcs['myint_succ']
+        calls = []
+        hook = wrap.add_hook([succ], after=calls.append)
+        succ.enable_stats()
+        succ(1)
+        hook.remove()
+        succ(2)
+        assert len(calls) == 1 and succ.stats.calls == 2
+        succ.disable_stats()
+        assert type(succ) is wrap.CFunction
+
+
+## Call history and replay
+
+class TestCallHistory:
+    def test_ring(self):
+        funcs = wrap.wrapall(ffi, api)
+        history = wrap.record_calls(funcs, size=4)
+        for i in range(6):
+            funcs['myint_succ'](i)
+        records = history.dump()
+        assert history.count == 6
+        assert [(r['name'], r['args'], r['result']) for r in records] == \
+            [('myint_succ', [i], i + 1) for i in range(2, 6)]
+        assert records[0]['time'] <= records[-1]['time']
+        history.stop()
+        assert type(funcs['myint_succ']) is wrap.CFunction
+
+    def test_values(self):
+        funcs = wrap.wrapall(ffi, api)
+        history = wrap.record_calls(funcs)
+        p = funcs['make_point'](1, 2)
+        funcs['point_x'](p)
+        with raises(wrap.NullError):
+            funcs['mystr_name'](-1)
+        funcs['myfloat_succ'](1.5)
+        set_ptr_succ = wrap.cmethod(funcs['set_ptr_succ'], outargs=[1])
+        set_ptr_succ(3)
+        make, getx, err, flt, outarg = history.dump()[:5]
+        addr = int(ffi.cast('uintptr_t', p))
+        assert make['result'] == {'ptr': addr}
+        assert getx['args'] == [{'ptr': addr}] and getx['result'] == 1
+        assert err['error'] == 'NullError' and 'result' not in err
+        assert flt['args'] == [1.5] and flt['result'] == 2.5
+        assert outarg['outargs'] == [[1, 'o']]
+        funcs['del_point'](p)
+        history.stop()
+
+    def test_replay(self, tmpdir):
+        funcs = wrap.wrapall(ffi, api)
+        history = wrap.record_calls(funcs)
+        p = funcs['make_point'](3, 4)
+        funcs['point_setx'](p, 5)
+        funcs['point_x'](p)
+        funcs['del_point'](p)
+        history.stop()
+        path = str(tmpdir.join('calls.json'))
+        history.save(path)
+
+        replayed = wrap.wrapall(ffi, api)
+        seen = []
+        wrap.add_hook(replayed, after=lambda call: seen.append((call.name, call.result)))
+        alive = replayed['point_count']()
+        result = wrap.replay(path, replayed, repeat=2)
+        assert result['calls'] == 8 and result['errors'] == 0
+        assert result['elapsed'] > 0
+        assert [name for name, _ in seen[1:5]] == \
+            ['make_point', 'point_setx', 'point_x', 'del_point']
+        assert seen[3][1] == 5
+        # Points made in the replay were freed by it too
+        assert replayed['point_count']() == alive
+
+    def test_replay_arrays(self):
+        funcs = wrap.wrapall(ffi, api)
+        history = wrap.record_calls(funcs)
+        n = 100000
+        funcs['myint_add_array'](4, ffi.new('int[]', n), n)
+        funcs['point_x'](ffi.new('point_t *'))  # Size not known
+        history.stop()
+        assert history.dump()[0]['args'][1]['size'] == n * ffi.sizeof('int')
+        result = wrap.replay(history.dump(), funcs)
+        assert result['calls'] == 1 and result['errors'] == 0
+        assert result['skipped'] == 1
+
+
 ## Struct tests
 
 # First just test passing and receiving CFFI structs
@@ -386,11 +1262,324 @@ class TestMyPoint:
         assert d == sqrt((mypoint2.x - mypoint.x)**2 
                          + (mypoint2.x - mypoint.x)**2)
 
-    #def test_del(self, mypoint):
-    #    del mypoint
-    #    # TODO This will be hard to test because Pypy's GC has delays. Might 
-    #    # just have to test in CPython and assume it works in Pypy. Or maybe
-    #    # there's a way to force a GC in pypy?
+    def test_del(self):
+        count = cfuncs['point_count']()
+        p = MyPoint(1, 2)
+        assert cfuncs['point_count']() == count + 1
+        del p
+        # Pypy's GC has delays, so only CPython releases the point right away
+        if not hasattr(sys, 'pypy_version_info'):
+            assert cfuncs['point_count']() == count
+
+    def test_close(self):
+        count = cfuncs['point_count']()
+        p = MyPoint(1, 2)
+        p.close()
+        assert p._cdata is None
+        assert cfuncs['point_count']() == count
+        p.close()
+        assert cfuncs['point_count']() == count
+
+    def test_python_cdel(self):
+        deleted = []
+
+        class PyPoint(wrap.CObject):
+            x = cproperty(cfuncs['point_x'])
+            _cnew = cstaticmethod(cfuncs['make_point'])
+            def _cdel(self):
+                deleted.append(self.x)
+                cfuncs['del_point'](self._cdata)
+
+        count = cfuncs['point_count']()
+        p = PyPoint(1, 2)
+        assert not p._cgc
+        p.close()
+        assert deleted == [1] and cfuncs['point_count']() == count
+        p = PyPoint(3, 4)
+        del p
+        if not hasattr(sys, 'pypy_version_info'):
+            assert deleted == [1, 3] and cfuncs['point_count']() == count
+
+    def test_context_manager(self):
+        count = cfuncs['point_count']()
+        with MyPoint(3, 4) as p:
+            assert p.x == 3
+            assert cfuncs['point_count']() == count + 1
+        assert cfuncs['point_count']() == count
+
+
+# Class creation time specialization
+
+class MyOtherError(Exception): pass
+
+class MyIntOther(MyInt2):
+    @staticmethod
+    def _checkerr(cfunc, args, retval):
+        if retval == cffi.FFI.NULL:
+            raise MyOtherError(cfunc.cname)
+        return retval
+
+class PointObj(wrap.CObject):
+    _ctype = 'point_t *'
+    y = cproperty(cfuncs['point_y'])
+    _cnew = cstaticmethod(cfuncs['make_point'])
+    _cdel = cmethod(cfuncs['del_point'])
+
+class TestCObjectType:
+    def test_bound_checkerr(self):
+        assert isinstance(MyInt1, wrap.CObjectType)
+        assert MyInt1.add._cbinding is not None
+        assert MyInt1.succ.fget._cbinding is not None
+        assert MyInt1.s_add._cbinding is None  # staticmethods are left alone
+        with raises(MyError):
+            MyInt2(1).null()
+
+    def test_inherited_rebound(self):
+        assert 'null' in vars(MyIntOther) and 'null' not in vars(MyInt2)
+        with raises(MyOtherError):
+            MyIntOther(1).null()
+        with raises(MyError):
+            MyInt1(1).null()
+        assert MyIntOther(1).add(2) == 3 and MyIntOther(1).doubled == 2
+
+    def test_no_checkerr(self):
+        assert MyFloat.null._cbinding == (None, None)
+        with raises(wrap.NullError):
+            MyFloat(1.0).null()
+        # Outside of CObjects the lookup is still done per call
+        assert cmethod(cfuncs['myint_add'])._cbinding is None
+
+    def test_forwarded_fields(self):
+        assert isinstance(vars(PointObj)['x'], wrap._cfield)
+        assert not isinstance(vars(PointObj)['y'], wrap._cfield)
+        with PointObj(4, 5) as p:
+            assert (p.x, p.y) == (4, 5)
+        with raises(AttributeError):
+            p.x
+
+    def test_bad_ctype(self):
+        with raises(TypeError):
+            type('IntObj', (wrap.CObject,), {'_ctype': ffi.typeof('int')})
+        with raises(TypeError):
+            type('NoObj', (wrap.CObject,), {'_ctype': 'nosuch_t *'})
+
+    def test_ctype_ffi(self):
+        # Without _cnew the FFI comes from the other cmethods/cproperties
+        Borrowed = type('Borrowed', (wrap.CObject,),
+                        {'_ctype': 'point_t *', 'y': cproperty(cfuncs['point_y'])})
+        p = Borrowed()
+        p._cdata = cfuncs['make_point'](1, 2)
+        assert (p.x, p.y) == (1, 2)
+        cfuncs['del_point'](p._cdata)
+
+
+# Cached cproperty getters
+
+class TestCachedProperty:
+    @fixture
+    def point(self):
+        funcs = wrap.wrapall(ffi, api)
+
+        class CachedPoint(wrap.CObject):
+            x = cproperty(funcs['point_x'], funcs['point_setx'], cache=True)
+            y = cproperty(funcs['point_y'], cache=True, ttl=0.05)
+            _cnew = cstaticmethod(funcs['make_point'])
+            _cdel = cmethod(funcs['del_point'])
+            sety = cmethod(funcs['point_sety'], mutates=True)
+
+        wrap.enable_stats(funcs)
+        yield CachedPoint(4, 5), funcs
+        wrap.disable_stats(funcs)
+
+    def test_cached(self, point):
+        p, funcs = point
+        assert p.x == 4 and p.x == 4
+        assert funcs['point_x'].stats.calls == 1
+        q = type(p)(6, 7)
+        assert q.x == 6 and p.x == 4
+        assert funcs['point_x'].stats.calls == 2
+
+    def test_setter_invalidates(self, point):
+        p, funcs = point
+        assert p.x == 4
+        p.x = 8
+        assert p.x == 8 and p.x == 8
+        assert funcs['point_x'].stats.calls == 2
+
+    def test_mutates_invalidates(self, point):
+        p, funcs = point
+        assert (p.x, p.y) == (4, 5)
+        p.sety(9)
+        assert (p.x, p.y) == (4, 9)
+        assert funcs['point_x'].stats.calls == 2
+        assert funcs['point_y'].stats.calls == 2
+
+    def test_ttl(self, point):
+        import time
+        p, funcs = point
+        assert p.y == 5 and p.y == 5
+        assert funcs['point_y'].stats.calls == 1
+        time.sleep(0.06)
+        assert p.y == 5
+        assert funcs['point_y'].stats.calls == 2
+
+    def test_cinvalidate(self, point):
+        p, funcs = point
+        assert (p.x, p.y) == (4, 5)
+        wrap.cinvalidate(p, 'x')
+        assert (p.x, p.y) == (4, 5)
+        assert funcs['point_x'].stats.calls == 2
+        assert funcs['point_y'].stats.calls == 1
+        wrap.cinvalidate(p)
+        assert (p.x, p.y) == (4, 5)
+        assert funcs['point_y'].stats.calls == 2
+
+
+# Returned struct pointers paired with their destructor
+
+class TestOwners:
+    def check_owned(self, owned):
+        count = cfuncs['point_count']()
+        p = owned['make_point'](6, 7)
+        assert isinstance(p, wrap.CStruct)
+        assert (p.x, p.y) == (6, 7)
+        assert cfuncs['point_count']() == count + 1
+        assert owned['point_x'](p) == 6
+        del p
+        if not hasattr(sys, 'pypy_version_info'):
+            assert cfuncs['point_count']() == count
+
+    def test_owners_explicit(self):
+        self.check_owned(wrap.wrapall(ffi, api,
+                                      owners={'make_point': 'del_point'}))
+
+    def test_owners_pattern(self):
+        owned = wrap.wrapall(ffi, api, owners={'make_*': 'del_*'})
+        assert owned['make_point'].destructor is not None
+        self.check_owned(owned)
+
+    def test_owners_cobject(self):
+        owned = wrap.wrapall(ffi, api, owners={'make_point': 'del_point'})
+
+        class OwnedPoint(wrap.CObject):
+            x = cproperty(owned['point_x'])
+            _cnew = cstaticmethod(owned['make_point'])
+
+        count = cfuncs['point_count']()
+        p = OwnedPoint(6, 7)
+        assert p._cgc and p.x == 6
+        assert cfuncs['point_count']() == count + 1
+        p.close()
+        assert cfuncs['point_count']() == count
+        p = OwnedPoint(8, 9)
+        assert p.x == 8
+        del p
+        if not hasattr(sys, 'pypy_version_info'):
+            assert cfuncs['point_count']() == count
+
+    def test_destructor_needs_pointer(self):
+        owned = wrap.wrapall(ffi, api)
+        with raises(TypeError):
+            owned['myint_succ'].set_destructor(owned['del_point'])
+        with raises(TypeError):
+            wrap.wrapall(ffi, api, owners={'myint_succ': 'del_point'})
+
+    def test_owners_pattern_skips_non_pointers(self):
+        # myint_* are mostly int returning, only myintp_null returns a pointer
+        owned = wrap.wrapall(ffi, api, owners={'myint*': 'del_point'})
+        assert owned['myint_succ'].destructor is None
+        assert owned['myint_succ'](1) == 2
+        assert owned['myintp_null'].destructor is not None
+
+
+# Live native object registry
+
+class TestLiveObjects:
+    @fixture
+    def tracking(self):
+        start = wrap.track_objects()
+        yield start
+        wrap.track_objects(False)
+
+    def test_report_leaks(self, tracking):
+        owned = wrap.wrapall(ffi, api, owners={'make_point': 'del_point'})
+        kept = [MyPoint(1, 2), MyPoint(3, 4), owned['make_point'](5, 6)]
+        MyPoint(7, 8)  # Collected straight away
+        assert wrap.live_objects() == {'MyPoint': 2, 'point_t': 1}
+        report = wrap.report_leaks(since=tracking)
+        assert report['MyPoint']['count'] == 2
+        (site, count), = report['MyPoint']['sites'].items()
+        assert count == 2
+        assert site.startswith('{0}:'.format(__file__.rstrip('c')))
+        assert 'in test_report_leaks' in site.split(' <- ')[0]
+        kept[0].close()
+        assert wrap.live_objects() == {'MyPoint': 1, 'point_t': 1}
+        del kept[1:]
+        if not hasattr(sys, 'pypy_version_info'):
+            assert wrap.report_leaks(since=tracking) == {}
+
+    def test_since_and_sampling(self, tracking):
+        old = MyPoint(1, 2)
+        start = wrap.track_objects(every=2)
+        points = [MyPoint(i, i) for i in range(4)]
+        report = wrap.report_leaks(since=start)
+        assert report['MyPoint']['count'] == 4
+        sites = report['MyPoint']['sites']
+        assert sites[None] == 2 and sum(sites.values()) == 4
+
+    def test_cycles_collected(self, tracking):
+        p = MyPoint(1, 2)
+        p.me = p
+        del p
+        assert wrap.report_leaks(since=tracking) == {}
+
+    def test_off(self):
+        p = MyPoint(1, 2)
+        assert wrap.live_objects() == {} and wrap.report_leaks() == {}
+
+
+# Pooled native objects
+
+class PooledPoint(MyPoint):
+    _cpool = 2
+
+    def _creset(self, x, y):
+        self.x = x
+        cfuncs['point_sety'](self, y)
+
+class TestCObjectPool:
+    def test_pool_reuse(self):
+        count = cfuncs['point_count']()
+        pool = PooledPoint._cfreelist()
+        hits = pool.hits
+        p = PooledPoint(1, 2)
+        assert cfuncs['point_count']() == count + 1
+        p.close()
+        # Released in to the pool, not freed
+        assert cfuncs['point_count']() == count + 1
+        q = PooledPoint(5, 6)
+        assert (q.x, q.y) == (5, 6)
+        assert pool.hits == hits + 1
+        assert cfuncs['point_count']() == count + 1
+        assert wrap.pool_stats()[__name__ + '.PooledPoint']['hits'] == pool.hits
+
+    def test_pool_bounded(self):
+        pool = PooledPoint._cfreelist()
+        pool.clear()
+        count = cfuncs['point_count']()
+        points = [PooledPoint(i, i) for i in range(4)]
+        for p in points:
+            p.close()
+        assert len(pool.items) == 2
+        assert cfuncs['point_count']() == count + 2
+        pool.clear()
+        assert cfuncs['point_count']() == count
+
+    def test_pool_needs_creset(self):
+        class BadPooledPoint(MyPoint):
+            _cpool = 2
+        with raises(TypeError):
+            BadPooledPoint(1, 2)
 
 
 # Now to test CStructType
@@ -432,6 +1621,34 @@ class TestMyPointStruct:
         with raises(TypeError):
             p = point_t(1, 2, 3)
 
+    def test_pool(self):
+        pooled_t = wrap.CStructType(ffi, 'point_t')
+        pooled_t.set_pool(2)
+        p = pooled_t(1, 2)
+        del p
+        p = pooled_t(3)
+        assert (p.x, p.y) == (3, 0)
+        assert pooled_t.pool.stats()['hits'] == 1
+        assert pooled_t.pool.stats()['misses'] == 1
+        key = pooled_t._pool_key
+        assert key.startswith('struct:point_t#')
+        assert wrap.pool_stats()[key]['hits'] == 1
+        pooled_t.set_pool(0)
+        assert pooled_t.pool is None
+        assert key not in wrap.pool_stats()
+
+    def test_pool_two_types(self):
+        a = wrap.CStructType(ffi, 'point_t')
+        b = wrap.CStructType(ffi, 'point_t')
+        a.set_pool(2)
+        b.set_pool(2)
+        assert a._pool_key != b._pool_key
+        assert {a._pool_key, b._pool_key} <= set(wrap.pool_stats())
+        b.set_pool(0)
+        assert b._pool_key not in wrap.pool_stats()
+        assert a._pool_key in wrap.pool_stats()
+        a.set_pool(0)
+
     def test_array(self):
         pa = point_t.array(10)
         assert len(pa) == 10
@@ -439,3 +1656,67 @@ class TestMyPointStruct:
         with raises(IndexError):
             pa[10].x == 0
 
+
+### Import time ###
+
+# Seconds, generous to allow for slow CI machines. numpy and cffi's C parser
+# alone take longer than this on some of them.
+IMPORT_BUDGET = float(os.environ.get('CFFICLOAK_IMPORT_BUDGET', 0.5))
+
+def _import_in_subprocess(code):
+    import subprocess
+    return subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).decode()
+
+def test_import_is_lazy():
+    out = _import_in_subprocess(
+        'import sys, cfficloak\n'
+        'print(sorted(m for m in ("numpy", "six", "pycparser", "json") if m in sys.modules))')
+    assert out.strip() == '[]'
+
+def test_import_budget():
+    times = _import_in_subprocess(
+        'import time\n'
+        'start = time.time()\n'
+        'import cfficloak\n'
+        'print(time.time() - start)')
+    assert float(times) < IMPORT_BUDGET
+
+def test_lazy_numpy_and_ffi():
+    out = _import_in_subprocess(
+        'import sys, cfficloak\n'
+        'a = cfficloak.carray([1, 2])\n'
+        'print("pycparser" in sys.modules, "numpy" in sys.modules)\n'
+        'n = cfficloak.nparray(a, 8)\n'
+        'print("numpy" in sys.modules, n.dtype, cfficloak.numpy is sys.modules["numpy"])')
+    assert out.split('\n')[:2] == ['True False', 'True uint8 True']
+
+
+### Benchmark suite ###
+
+def test_benchmarks_run(tmpdir):
+    import json
+    import bench_wrapc
+    out = str(tmpdir.join('bench.json'))
+    results = bench_wrapc.main(['-r', '1', '-t', '0', '-o', out])
+    with open(out) as f:
+        assert json.load(f) == json.loads(json.dumps(results))
+    names = results['results']
+    assert 'scalar/raw' in names and 'startup/wrapall' in names
+    assert all(r['best'] > 0 for r in names.values())
+
+
+def test_work_functions():
+    assert cfuncs['work_spin'](4) == 0.5 * (0 + 1 + 2 + 3)
+    assert cfuncs['work_sleep'](1) == 0
+
+def test_throughput_runs():
+    import bench_wrapc
+    results = bench_wrapc.main(['-k', 'work/cfunction_spin', '--threads', '2',
+                                '--processes', '2', '--duration', '0.05', '--work', '10'])
+    for mode in ('thread', 'process'):
+        scaling = results['scaling'][mode]['work/cfunction_spin']
+        assert sorted(scaling) == [1, 2]
+        assert scaling[1]['efficiency'] == 1.0
+        assert scaling[2]['calls_per_sec'] > 0